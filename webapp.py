@@ -1,46 +1,392 @@
 #!/usr/bin/env python3
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import os, sqlite3, urllib.parse, datetime, json
-from jinja2 import Environment, FileSystemLoader
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os, re, sqlite3, urllib.parse, datetime, json, queue, tempfile, atexit, shutil, threading, functools, itertools, csv, io, bisect
+import logging, logging.handlers
+from collections import namedtuple, OrderedDict
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 # =========================
 # [setup] Konfiguration
 # =========================
 DB_PATH = os.environ.get("SCHOOL_DB_PATH", os.path.join(os.getcwd(), "school.db"))
 LESSON_MINUTES = int(os.environ.get("LESSON_MINUTES", "45"))  # für Fehlstunden→Minuten
+ADMIN_LOG_PAGE_SIZE = 50  # Einträge pro Seite im Änderungsprotokoll
+# Bei jeder Schema-Änderung in ensure_schema_migrations() hochzählen (PRAGMA user_version)
+SCHEMA_VERSION = 10
+
+# Fehler-Log (server.log): Handler einmal anlegen, rotiert bei 5 MB; Datei erst beim ersten Fehler öffnen
+logger = logging.getLogger("school")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if not logger.handlers:
+    _log_handler = logging.handlers.RotatingFileHandler(
+        "server.log", maxBytes=5_000_000, backupCount=3, encoding="utf-8", delay=True)
+    _log_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s"))
+    logger.addHandler(_log_handler)
 
 # Jinja2 Template-Setup
-template_env = Environment(loader=FileSystemLoader(os.path.join(os.getcwd(), "templates")), autoescape=True)
-
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+# Bytecode-Cache: kompilierte Templates überleben Neustarts; auto_reload=False spart
+# den mtime-Check pro Render (nach Template-Änderungen Server neu starten).
+# Ohne directory legt Jinja ein eigenes Verzeichnis pro Benutzer an (0700, Eigentümer
+# geprüft): ein fremdes, vorab angelegtes Temp-Verzeichnis kann keinen Bytecode unterschieben.
+_jinja_bcc = FileSystemBytecodeCache(pattern="lehrerdb_tpl_%s.cache")
+template_env = Environment(loader=FileSystemLoader(os.path.join(os.getcwd(), "templates")), autoescape=True,
+                           bytecode_cache=_jinja_bcc, auto_reload=False, cache_size=-1)
+
+def _warm_template_cache():
+    """Alle Templates einmal laden, damit kein Request die Erst-Kompilierung bezahlt."""
+    for name in template_env.list_templates(extensions=["html"]):
+        template_env.get_template(name)
+
+DB_POOL_SIZE = int(os.environ.get("SCHOOL_DB_POOL_SIZE", "8"))
+
+def _volatile_db_path():
+    """
+    Wegwerf-DB für SCHOOL_DB_PATH=":memory:": eine Datei in einem privaten Temp-Verzeichnis,
+    das beim Beenden gelöscht wird. Eine Shared-Cache-In-Memory-DB ginge nicht: sie sperrt
+    auf Tabellenebene, parallele Schreiber der Pool-Verbindungen scheitern dort sofort mit
+    "database table is locked" (kein Warten über den Busy-Timeout).
+    """
+    directory = tempfile.mkdtemp(prefix="lehrerdb-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    return os.path.join(directory, "school.db")
+
+# SCHOOL_DB_PATH=":memory:" (z.B. für Tests): flüchtige DB, siehe _volatile_db_path().
+# "file:..."-Pfade werden als SQLite-URI geöffnet.
+_DB_TARGET = _volatile_db_path() if DB_PATH == ":memory:" else DB_PATH
+_DB_IS_URI = _DB_TARGET.startswith("file:")
+_wal_enabled = False  # journal_mode=WAL ist in der DB-Datei persistent: einmal pro Prozess reicht
+
+def _open_db_connection():
+    """Neue SQLite-Verbindung; Pragmas werden einmal bei der Erzeugung gesetzt."""
+    global _wal_enabled
+    # Pool-Verbindungen leben lange: größerer Statement-Cache (Default 128), damit alle
+    # Handler-Abfragen vorbereitet bleiben
+    conn = sqlite3.connect(_DB_TARGET, uri=_DB_IS_URI, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    if not _wal_enabled:
+        conn.execute("PRAGMA journal_mode=WAL")
+        _wal_enabled = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB je Verbindung
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
+class _ConnectionPool:
+    """
+    Prozessweiter Pool langlebiger Verbindungen. Eine Verbindung wird immer nur
+    an einen Thread gleichzeitig ausgegeben (über die Queue). Ist der Pool leer
+    (z.B. verschachtelte get_db_connection()-Aufrufe), wird eine Zusatzverbindung
+    geöffnet, die beim Zurückgeben wieder geschlossen wird.
+    """
+    def __init__(self, size):
+        self.size = max(1, size)
+        # LIFO: die zuletzt benutzte Verbindung (warmer Page-/Statement-Cache) kommt zuerst
+        self._idle = queue.LifoQueue(maxsize=self.size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _open_db_connection()
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+                _invalidate_caches()
+            _flush_pending_ids(conn, committed=False)
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+_db_pool = _ConnectionPool(DB_POOL_SIZE)
+
+class _PooledConnection:
+    """
+    Verhält sich wie sqlite3.Connection; close() gibt die Verbindung an den Pool
+    zurück (offene Transaktionen werden verworfen, wie bei sqlite3 auch).
+    """
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
+
+    def __enter__(self):
+        return self
+
+    def write_tx(self):
+        """
+        Für `with conn.write_tx():` – Transaktion mit BEGIN IMMEDIATE, d.h. die
+        Schreibsperre wird gleich zu Beginn geholt (Wartezeit über den Busy-Timeout).
+        Lesende Prüfungen vor dem ersten Schreiben sehen so denselben Stand.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        conn = self._conn
+        if conn is None:
+            return False
+        if exc_type is not None:
+            _invalidate_caches()  # Rollback: evtl. gecachte neue IDs verwerfen
+        committed = False
+        try:
+            result = conn.__exit__(exc_type, exc, tb)
+            committed = exc_type is None
+            return result
+        finally:
+            _flush_pending_ids(conn, committed)
+
+    def commit(self):
+        self._conn.commit()
+        _flush_pending_ids(self._conn, committed=True)
+
+    def rollback(self):
+        self._conn.rollback()
+        _flush_pending_ids(self._conn, committed=False)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            _db_pool.release(conn)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+# Schema-Migration läuft einmal pro Prozess beim ersten DB-Zugriff (nicht beim Import)
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def _ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            ensure_schema_migrations()
+            _schema_ready = True
+
+def get_db_connection():
+    _ensure_schema()
+    return _PooledConnection(_db_pool.acquire())
+
+_students_fts = None
+_timetable_unique = False
+
+def _timetable_unique_ready(cur):
+    """Gibt es ux_tt_class und ux_tt_course? (Sobald vorhanden, nicht mehr geprüft.)"""
+    global _timetable_unique
+    if not _timetable_unique:
+        _timetable_unique = cur.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='index' AND name IN ('ux_tt_class', 'ux_tt_course')"
+        ).fetchone()[0] == 2
+    return _timetable_unique
+
+
+_unique_indexes = set()
+
+def _has_unique_index(cur, name):
+    """Gibt es den eindeutigen Index name? (Sobald vorhanden, nicht mehr geprüft.)"""
+    if name not in _unique_indexes and cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (name,)).fetchone():
+        _unique_indexes.add(name)
+    return name in _unique_indexes
+
+
+def _students_fts_ready(cur):
+    """Gibt es den Suchindex students_fts? (einmal pro Prozess geprüft)"""
+    global _students_fts
+    if _students_fts is None:
+        _students_fts = cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='students_fts'").fetchone() is not None
+    return _students_fts
+
 # =========================
 # Helper / Utilities
 # =========================
 
 # Stundenplan-Raster
-SCHEDULE_PATTERN = [
-    {'period': 1, 'label': '1- 08:00-08:45'},
-    {'period': 2, 'label': '2- 08:45-09:30'},
-    {'break': 25, 'label': 'Pause 25min'},
-    {'period': 3, 'label': '3- 09:55-10:40'},
-    {'period': 4, 'label': '4- 10:40-11:25'},
-    {'break': 20, 'label': 'Pause 20min'},
-    {'period': 5, 'label': '5- 11:45-12:30'},
-    {'period': 6, 'label': '6- 12:30-13:15'},
-    {'break': 45, 'label': 'Pause 45min'},
-    {'period': 8, 'label': '8- 14:00-14:45'},
-    {'period': 9, 'label': '9- 14:45-15:30'},
-]
+_Slot = namedtuple("_Slot", "kind value label")  # kind: 'period' (value=Stunde) | 'break' (value=Minuten)
+
+@functools.lru_cache(maxsize=1)
+def _schedule_pattern():
+    """Wird erst beim ersten Zugriff aufgebaut und dann wiederverwendet."""
+    return (
+        _Slot('period', 1, '1- 08:00-08:45'),
+        _Slot('period', 2, '2- 08:45-09:30'),
+        _Slot('break', 25, 'Pause 25min'),
+        _Slot('period', 3, '3- 09:55-10:40'),
+        _Slot('period', 4, '4- 10:40-11:25'),
+        _Slot('break', 20, 'Pause 20min'),
+        _Slot('period', 5, '5- 11:45-12:30'),
+        _Slot('period', 6, '6- 12:30-13:15'),
+        _Slot('break', 45, 'Pause 45min'),
+        _Slot('period', 8, '8- 14:00-14:45'),
+        _Slot('period', 9, '9- 14:45-15:30'),
+    )
+
+@functools.lru_cache(maxsize=1)
+def _schedule_periods():
+    """Nur die Unterrichtsstunden des Rasters, z.B. (1, 2, 3, 4, 5, 6, 8, 9)."""
+    return tuple(slot.value for slot in _schedule_pattern() if slot.kind == 'period')
+
+# Bereits erfasste Anwesenheit / Note einer Stunde (Erfassungsmaske)
+_Attendance = namedtuple("_Attendance", "status absent_minutes late_minutes")
+_Grade = namedtuple("_Grade", "grade comment")
+
+# Klassen-/Kursname: Jahrgang + Buchstaben, z.B. '10f', '7sw'
+_GROUP_RE = re.compile(r"^(\d+)([A-Za-z]+)$")
+
+# Klassenliste: erlaubte Sortierschlüssel -> ORDER BY-Terme (Whitelist, nie Nutzereingabe in SQL).
+# Klassen ohne Noten (bzw. Schnitt 0) sortieren wie früher hinter alle anderen.
+CLASS_SORT_COLUMNS = {
+    "name": ("c.name COLLATE NOCASE",),
+    "size": ("student_count",),
+    "avg":  ("NULLIF(ga.avg_grade, 0) IS NULL", "ga.avg_grade"),
+    "fehl": ("absent_minutes",),
+    "late": ("late_minutes",),
+    "id":   ("c.id",),
+}
+
+# Schülerliste: Sortierschlüssel -> Spalte (Gleichstand immer nach s.id)
+STUDENT_SORT_COLUMNS = {
+    "first": "s.first_name",
+    "last":  "s.last_name",
+    "class": "c.name",
+    "course": "d.name",
+    "id":    "s.id",
+}
+
+# Anzeige der Kursleitung als "Kürzel (Name)" (Alias t = teachers)
+_LEADER_SQL = "COALESCE(t.short, '') || CASE WHEN COALESCE(t.name, '') <> '' THEN ' (' || t.name || ')' ELSE '' END"
+
+# Kursliste: wie oben, zusätzlich nach Kursleitung
+COURSE_SORT_COLUMNS = {
+    "name": ("d.name COLLATE NOCASE",),
+    "size": ("student_count",),
+    "avg":  ("NULLIF(ga.avg_grade, 0) IS NULL", "ga.avg_grade"),
+    "fehl": ("absent_minutes",),
+    "late": ("late_minutes",),
+    "id":   ("d.id",),
+    "leader": (_LEADER_SQL + " COLLATE NOCASE",),
+}
+
+def _sort_link_table(url_template, columns):
+    """Sortier-Links je Spalte und Richtung, einmal beim Import vorberechnet."""
+    return {d: {col: url_template.format(col=col, d=d) for col in columns}
+            for d in ("asc", "desc")}
+
+_CLASS_SORT_LINKS = _sort_link_table("/classes?sort={col}&dir={d}", CLASS_SORT_COLUMNS)
+_COURSE_SORT_LINKS = _sort_link_table("/courses?sort={col}&dir={d}", COURSE_SORT_COLUMNS)
+# {pre}/{post} bleiben als Platzhalter stehen: Filter vor, limit hinter sort/dir (pro Anfrage)
+_STUDENT_SORT_LINKS = _sort_link_table("/students?{{pre}}sort={col}&dir={d}{{post}}", STUDENT_SORT_COLUMNS)
+
+def _sort_links(table, sort, direction):
+    """Alle Spalten aufsteigend, nur die aktuell aufsteigend sortierte Spalte schaltet auf absteigend."""
+    links = table["asc"]
+    if direction == "asc" and sort in links:
+        links = dict(links)
+        links[sort] = table["desc"][sort]
+    return links
+
+_HTML_ESCAPE_TABLE = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;",
+})
 
 def html_escape(text: str) -> str:
-    from html import escape as _e
     if text is None:
         return ""
-    return _e(str(text), quote=True).replace("'", "&#39;")
+    return str(text).translate(_HTML_ESCAPE_TABLE)
+
+def _fast_parse_qsl(raw: bytes):
+    """
+    parse_qsl() für Formular-Bodies (keep_blank_values=True). Enthält der Body weder
+    '%' noch '+', ist nichts zu dekodieren: dann reicht split() statt urllib.parse.
+    """
+    if b"%" in raw or b"+" in raw:
+        return urllib.parse.parse_qsl(raw.decode("utf-8"), keep_blank_values=True)
+    pairs = []
+    for field in raw.decode("utf-8").split("&"):
+        if field:
+            k, _, v = field.partition("=")
+            pairs.append((k, v))
+    return pairs
+
+def _parse_nonneg_int(value):
+    """' 25' -> 25 (nur ASCII-Ziffern, Leerraum außen erlaubt); None, leer oder ungültig -> None."""
+    value = (value or "").strip()
+    return int(value) if value.isascii() and value.isdigit() else None
+
+def _parse_positive_int(value):
+    """'25' -> 25; leere, ungültige oder nicht positive Werte -> None."""
+    return _parse_nonneg_int(value) or None
+
+def _parse_int(data, key, default=0):
+    """Formularfeld als nicht-negative Ganzzahl; fehlend, leer oder ungültig -> default."""
+    number = _parse_nonneg_int(data.get(key))
+    return default if number is None else number
+
+@functools.lru_cache(maxsize=256)
+def _parse_scale_def(definition):
+    """
+    Notenschlüssel-Text ("Note;min;max" je Zeile) -> Tupel (Note, min, max).
+    Gecacht über den Text selbst: ein geänderter Schlüssel ist ein neuer Eintrag.
+    """
+    scale_def = []
+    for ln in definition.splitlines():
+        parts = [p.strip() for p in ln.split(';')]
+        if len(parts) == 3:
+            try:
+                scale_def.append((parts[0], float(parts[1]), float(parts[2])))
+            except ValueError:
+                continue
+    return tuple(scale_def)
+
+@functools.lru_cache(maxsize=256)
+def _scale_index(scale_def):
+    """
+    Sortierte Untergrenzen für bisect, falls sich die Stufen nicht überlappen
+    (leere Stufen min >= max passen nie und fallen weg). Sonst None.
+    """
+    entries = sorted((e for e in scale_def if e[1] < e[2]), key=lambda e: e[1])
+    if any(prev[2] > cur[1] for prev, cur in zip(entries, entries[1:])):
+        return None
+    return [e[1] for e in entries], entries
+
+def _grade_for_pct(scale_def, pct):
+    """Note der ersten Stufe mit min <= pct < max, '' wenn keine passt."""
+    index = _scale_index(scale_def)
+    if index is None:
+        # Überlappende Stufen: Reihenfolge der Definition entscheidet
+        return next((g for g, mi, ma in scale_def if mi <= pct < ma), '')
+    mins, entries = index
+    i = bisect.bisect_right(mins, pct) - 1
+    return entries[i][0] if i >= 0 and pct < entries[i][2] else ''
+
+def _keyset_after(expr, descending, anchor_value, anchor_id, id_expr):
+    """
+    WHERE-Bedingung für "Zeilen nach dem Anker" bei ORDER BY expr [DESC], id ASC.
+    NULL-Werte stehen in SQLite aufsteigend vorn, absteigend hinten.
+    """
+    if anchor_value is None:
+        if descending:
+            return f"({expr} IS NULL AND {id_expr} > ?)", [anchor_id]
+        return f"({expr} IS NOT NULL OR {id_expr} > ?)", [anchor_id]
+    op = "<" if descending else ">"
+    nulls_after = f" OR {expr} IS NULL" if descending else ""
+    return (f"({expr} {op} ?{nulls_after} OR ({expr} = ? AND {id_expr} > ?))",
+            [anchor_value, anchor_value, anchor_id])
 
 def _normalize_group_name(name: str) -> str:
     """
@@ -50,46 +396,135 @@ def _normalize_group_name(name: str) -> str:
     name = (name or "").strip()
     if not name:
         return name
-    import re
-    m = re.match(r"^(\d+)([A-Za-z]+)$", name.strip())
+    m = _GROUP_RE.match(name)
     if m:
         grade, suffix = m.group(1), m.group(2)
         return grade + suffix.upper()
     return ''.join(ch.upper() if ch.isalpha() else ch for ch in name)
 
+# Stammdaten für Auswahllisten (Klassen, Kurse, Lehrer, Fächer) ändern sich nur über
+# wenige Schreibpfade: Ergebnis bis zur nächsten Änderung cachen. Schreibende Handler
+# rufen nach dem Commit _bump_ref_version() auf (auch _invalidate_caches() tut das).
+_ref_version_counter = itertools.count(1)
+_ref_version = 0
+_ref_cache = {}
+
+def _bump_ref_version():
+    global _ref_version
+    _ref_version = next(_ref_version_counter)
+
+def _cached_ref_rows(cur, sql):
+    version = _ref_version  # vor der Abfrage lesen: ein paralleler Bump macht den Eintrag ungültig
+    hit = _ref_cache.get(sql)
+    if hit is not None and hit[0] == version:
+        return hit[1]
+    rows = tuple(cur.execute(sql).fetchall())
+    _ref_cache[sql] = (version, rows)
+    return rows
+
 def get_all_classes(cur):
-    return cur.execute("SELECT id, name FROM classes ORDER BY name ASC").fetchall()
+    return _cached_ref_rows(cur, "SELECT id, name FROM classes ORDER BY name ASC")
 
 def get_all_courses(cur):
-    return cur.execute("SELECT id, name FROM courses ORDER BY name ASC").fetchall()
+    return _cached_ref_rows(cur, "SELECT id, name FROM courses ORDER BY name ASC")
 
 def get_all_teachers(cur):
-    return cur.execute("SELECT id, short, name FROM teachers ORDER BY short ASC").fetchall()
+    return _cached_ref_rows(cur, "SELECT id, short, name FROM teachers ORDER BY short ASC")
 
 def get_all_subjects(cur):
-    return cur.execute("SELECT id, name, short FROM subjects ORDER BY name ASC").fetchall()
+    return _cached_ref_rows(cur, "SELECT id, name, short FROM subjects ORDER BY name ASC")
+
+class _LRUCache:
+    """Kleiner threadsicherer LRU-Cache mit fester Obergrenze (älteste Einträge fliegen raus)."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Name→ID-Caches für get_or_create_* (Schlüssel: normalisierter Name, lowercase)
+_class_id_cache = _LRUCache(512)
+_course_id_cache = _LRUCache(512)
+
+# IDs aus einer offenen Transaktion (rohe Verbindung -> [(cache, key, id)]): erst nach dem
+# COMMIT in den Cache, sonst sähen andere Threads eine ID, die es nach einem Rollback nicht gibt
+_pending_ids = {}
+
+def _cache_id(cur, cache, key, value):
+    conn = cur.connection
+    if conn.in_transaction:
+        _pending_ids.setdefault(conn, []).append((cache, key, value))
+    else:
+        cache.put(key, value)
+
+def _flush_pending_ids(conn, committed):
+    """Nach COMMIT übernehmen, nach Rollback verwerfen."""
+    pending = _pending_ids.pop(conn, None)
+    if committed and pending:
+        for cache, key, value in pending:
+            cache.put(key, value)
+
+def _invalidate_caches():
+    """Nach DELETE/Rollback aufrufen, damit keine veralteten IDs ausgeliefert werden."""
+    _class_id_cache.clear()
+    _course_id_cache.clear()
+    _bump_ref_version()
 
 def get_or_create_class(cur, name: str):
     name = (name or "").strip()
     if not name:
         return None
     norm_name = _normalize_group_name(name)
-    row = cur.execute("SELECT id FROM classes WHERE LOWER(name)=LOWER(?)", (norm_name,)).fetchone()
+    key = norm_name.lower()
+    cached = _class_id_cache.get(key)
+    if cached is not None:
+        return cached
+    row = cur.execute("SELECT id FROM classes WHERE name=? COLLATE NOCASE", (norm_name,)).fetchone()
     if row:
+        _cache_id(cur, _class_id_cache, key, row["id"])
         return row["id"]
-    cur.execute("INSERT INTO classes(name) VALUES(?)", (norm_name,))
-    return cur.lastrowid
+    # Upsert statt INSERT: legt eine parallel angelegte Klasse nicht doppelt an
+    new_id = cur.execute(
+        "INSERT INTO classes(name) VALUES(?) ON CONFLICT(name) DO UPDATE SET name=excluded.name RETURNING id",
+        (norm_name,)).fetchone()[0]
+    _cache_id(cur, _class_id_cache, key, new_id)
+    return new_id
 
 def get_or_create_course(cur, name: str):
     name = (name or "").strip()
     if not name:
         return None
     norm_name = _normalize_group_name(name)
-    row = cur.execute("SELECT id FROM courses WHERE LOWER(name)=LOWER(?)", (norm_name,)).fetchone()
+    key = norm_name.lower()
+    cached = _course_id_cache.get(key)
+    if cached is not None:
+        return cached
+    row = cur.execute("SELECT id FROM courses WHERE name=? COLLATE NOCASE", (norm_name,)).fetchone()
     if row:
+        _cache_id(cur, _course_id_cache, key, row["id"])
         return row["id"]
-    cur.execute("INSERT INTO courses(name, class_id) VALUES(?, NULL)", (norm_name,))
-    return cur.lastrowid
+    new_id = cur.execute(
+        "INSERT INTO courses(name, class_id) VALUES(?, NULL) ON CONFLICT(name) DO UPDATE SET name=excluded.name RETURNING id",
+        (norm_name,)).fetchone()[0]
+    _cache_id(cur, _course_id_cache, key, new_id)
+    return new_id
 
 def create_teacher(cur, short: str, name: str):
     short = (short or "").strip()
@@ -108,26 +543,35 @@ def create_teacher(cur, short: str, name: str):
     cur.execute("INSERT INTO teachers(short, name) VALUES(?,?)", (short, name))
     return cur.lastrowid
 
-def get_or_create_subject(cur, name: str, short: str = None):
-    name = (name or "").strip()
-    if not name:
-        return None
-    row = cur.execute("SELECT id FROM subjects WHERE LOWER(name)=LOWER(?)", (name,)).fetchone()
-    if row:
-        return row["id"]
-    short_norm = None
-    if short:
-        short_norm = short.strip().upper() or None
-    if not short_norm:
-        short_norm = name.strip().upper()[:8]
-    cur.execute("INSERT INTO subjects(name, short) VALUES(?, ?)", (name, short_norm))
-    return cur.lastrowid
+def _ids_by_name(cur, table, names):
+    """Liefert {name.lower(): id} für alle vorhandenen Namen (case-insensitive)."""
+    keys = list({n.lower() for n in names})
+    if not keys:
+        return {}
+    ph = ",".join("?" * len(keys))
+    ids = {}
+    for r in cur.execute(f"SELECT id, name FROM {table} WHERE name COLLATE NOCASE IN ({ph})", keys):
+        ids.setdefault(r["name"].lower(), r["id"])
+    return ids
 
-def populate_default_timetable(cur):
+def _bulk_get_or_create(cur, table, columns, rows):
     """
-    Wöchentlicher Defaultplan (date=NULL). Siehe ursprüngliche Beispiel-Daten.
+    Mengen-Variante von get_or_create_*: rows sind Insert-Tupel mit dem (bereits
+    normalisierten) Namen an erster Stelle. Fehlende Namen werden per executemany angelegt.
     """
-    entries = [
+    rows = list(rows)
+    ids = _ids_by_name(cur, table, [r[0] for r in rows])
+    missing = [r for r in rows if r[0].lower() not in ids]
+    if missing:
+        ph = ",".join("?" * len(missing[0]))
+        cur.executemany(f"INSERT OR IGNORE INTO {table}({columns}) VALUES({ph})", missing)
+        ids.update(_ids_by_name(cur, table, [r[0] for r in missing]))
+    return ids
+
+# Wöchentlicher Defaultplan: (Tag, Stunde, Gruppe, Fach-Kürzel, Raum, Doppelstunde)
+@functools.lru_cache(maxsize=1)
+def _default_timetable_entries():
+    return (
         # Montag
         ("Montag", 1, "5f", "PFAG", "212", True),
         ("Montag", 3, "7sw", "PH", "136", False),
@@ -153,64 +597,121 @@ def populate_default_timetable(cur):
         ("Freitag", 3, "9if", "PH", "236", False),
         ("Freitag", 5, "7ch", "PH", "239", False),
         ("Freitag", 6, "7if", "PH", "232", False),
-    ]
+    )
 
-    subject_map = {
-        'PFAG': ('PFAG', 'PFAG'),
-        'AS': ('AS', 'AS'),
-        'PH': ('Physik', 'PH'),
-        'IF': ('IF', 'IF'),
-        'M': ('M', 'M'),
-    }
-    import re
-    for day, period, group_name, subj_token, room, is_double in entries:
-        group_norm = _normalize_group_name(group_name)
-        m = re.match(r"^(\d+)([A-Za-z]+)$", group_norm)
-        class_id = None
-        course_id = None
-        if m:
-            grade, suffix = m.group(1), m.group(2)
-            if len(suffix) == 1:
-                class_id = get_or_create_class(cur, group_norm)
-            else:
-                course_id = get_or_create_course(cur, group_norm)
-                class_id = get_or_create_class(cur, group_norm)
-        else:
-            class_id = get_or_create_class(cur, group_norm)
-
-        if subj_token in subject_map:
-            subj_name, subj_short = subject_map[subj_token]
-        else:
-            subj_name, subj_short = subj_token, subj_token
-        subj_id = get_or_create_subject(cur, subj_name, subj_short)
+# Fach-Kürzel im Defaultplan -> (Fachname, Kürzel)
+_SUBJECT_MAP = {
+    'PFAG': ('PFAG', 'PFAG'),
+    'AS': ('AS', 'AS'),
+    'PH': ('Physik', 'PH'),
+    'IF': ('IF', 'IF'),
+    'M': ('M', 'M'),
+}
 
-        cur.execute(
-            "INSERT INTO timetable(class_id, course_id, period, is_double, slot, day, time_range, date, subject_id, room, status) "
-            "VALUES(?,?,?,?,?,?,?,?,?,?,?)",
+def populate_default_timetable(cur):
+    """
+    Wöchentlicher Defaultplan (date=NULL). Siehe ursprüngliche Beispiel-Daten.
+    """
+    # Namen zuerst sammeln, dann je Tabelle in einem Rutsch auflösen/anlegen
+    resolved = []
+    class_rows, course_rows, subject_rows = {}, {}, {}
+    for day, period, group_name, subj_token, room, is_double in _default_timetable_entries():
+        group_norm = _normalize_group_name(group_name)
+        m = _GROUP_RE.match(group_norm)
+        is_course = bool(m) and len(m.group(2)) != 1
+        class_rows.setdefault(group_norm.lower(), (group_norm,))
+        if is_course:
+            course_rows.setdefault(group_norm.lower(), (group_norm, None))
+
+        subj_name, subj_short = _SUBJECT_MAP.get(subj_token, (subj_token, subj_token))
+        subject_rows.setdefault(subj_name.lower(), (subj_name, subj_short.strip().upper()))
+        resolved.append((day, period, group_norm.lower(), is_course, subj_name.lower(), room, is_double))
+
+    course_ids = _bulk_get_or_create(cur, "courses", "name, class_id", course_rows.values())
+    class_ids = _bulk_get_or_create(cur, "classes", "name", class_rows.values())
+    subject_ids = _bulk_get_or_create(cur, "subjects", "name, short", subject_rows.values())
+
+    cur.executemany(
+        "INSERT INTO timetable(class_id, course_id, period, is_double, slot, day, time_range, date, subject_id, room, status) "
+        "VALUES(?,?,?,?,?,?,?,?,?,?,?)",
+        [
             (
-                class_id,
-                course_id,
+                class_ids.get(group_key),
+                course_ids.get(group_key) if is_course else None,
                 period,
-                1 if is_double else 0,
+                int(is_double),
                 period,
                 day,
                 None,
                 None,
-                subj_id,
+                subject_ids.get(subj_key),
                 room,
                 None,
-            ),
-        )
+            )
+            for day, period, group_key, is_course, subj_key, room, is_double in resolved
+        ],
+    )
 
 # =========================
 # Schema Migration
 # =========================
+def _executescript_in_tx(cur, script):
+    """
+    Wie cur.executescript(), aber ohne dessen implizites COMMIT: die Anweisungen
+    laufen einzeln innerhalb der bereits offenen Transaktion.
+    """
+    stmt = ""
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            cur.execute(stmt)
+            stmt = ""
+    if stmt.strip():
+        cur.execute(stmt)
+
+def _create_unique_index(cur, name, table, cols, where=None):
+    """
+    Legt einen eindeutigen Index an. Enthält die Tabelle schon Doppelte, wird nichts
+    gelöscht: es bleibt bei einer Warnung mit der Anzahl, Rückgabe False.
+    """
+    col_list = ", ".join(cols)
+    cond = f" WHERE {where}" if where else ""
+    try:
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table}({col_list}){cond}")
+    except sqlite3.IntegrityError:
+        not_null = " AND ".join(f"{c} IS NOT NULL" for c in cols)
+        groups, surplus = cur.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(n) - COUNT(*), 0) FROM ("
+            f"SELECT COUNT(*) AS n FROM {table} WHERE {not_null}{' AND ' + where if where else ''} "
+            f"GROUP BY {col_list} HAVING n > 1)"
+        ).fetchone()
+        logger.warning("Index %s nicht angelegt: %s enthält %d doppelte Zeilen in %d Gruppen (%s)",
+                       name, table, surplus, groups, col_list)
+        return False
+    return True
+
 def ensure_schema_migrations():
-    conn = get_db_connection()
+    _invalidate_caches()
+    conn = _PooledConnection(_db_pool.acquire())  # nicht get_db_connection(): das ruft uns auf
     cur = conn.cursor()
+    try:
+        # Bereits migriert? Dann reicht ein einziger PRAGMA-Aufruf.
+        if cur.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            return
+        # Gesamte Migration inkl. Default-Daten in einer Transaktion (ein Sync beim COMMIT)
+        cur.execute("BEGIN IMMEDIATE")
+        if cur.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            _migrate_schema(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
+def _migrate_schema(cur):
     # ---- Basistabellen
-    cur.executescript("""
+    _executescript_in_tx(cur, """
     CREATE TABLE IF NOT EXISTS teachers(
       id INTEGER PRIMARY KEY,
       short TEXT UNIQUE,
@@ -253,7 +754,7 @@ def ensure_schema_migrations():
     """)
 
     # Erweiterungen
-    cur.executescript("""
+    _executescript_in_tx(cur, """
     CREATE TABLE IF NOT EXISTS subjects(
       id INTEGER PRIMARY KEY,
       name TEXT UNIQUE NOT NULL,
@@ -285,12 +786,15 @@ def ensure_schema_migrations():
     );
     """)
 
+    table_cols = {}
     def col_exists(table, col):
-        cur.execute(f"PRAGMA table_info({table})")
-        return any(r["name"] == col for r in cur.fetchall())
+        if table not in table_cols:
+            cur.execute(f"PRAGMA table_info({table})")
+            table_cols[table] = {r["name"] for r in cur.fetchall()}
+        return col in table_cols[table]
 
     # ---- Notenschlüssel
-    cur.executescript("""
+    _executescript_in_tx(cur, """
     CREATE TABLE IF NOT EXISTS grade_scales(
       id INTEGER PRIMARY KEY,
       name TEXT NOT NULL,
@@ -299,7 +803,7 @@ def ensure_schema_migrations():
     """)
 
     # ---- Leistungsabfragen (zuerst anlegen, dann evtl. alter)
-    cur.executescript("""
+    _executescript_in_tx(cur, """
     CREATE TABLE IF NOT EXISTS performance_queries(
         id INTEGER PRIMARY KEY,
         type TEXT NOT NULL,
@@ -358,6 +862,79 @@ def ensure_schema_migrations():
     # subjects.short unique index (falls nötig)
     cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_subjects_short ON subjects(short)")
 
+    # ---- Indizes für die häufigsten Filter (Stundenplan, Erfassung, Schülerlisten).
+    # Die eindeutigen (student_id, date, period[, subject])-Indizes weiter unten ersetzen
+    # die älteren (student_id, date)-Indizes.
+    _executescript_in_tx(cur, """
+    CREATE INDEX IF NOT EXISTS idx_tt_day_period ON timetable(day, period);
+    CREATE INDEX IF NOT EXISTS idx_tt_date_period ON timetable(date, period);
+    CREATE INDEX IF NOT EXISTS idx_att_date_period ON attendance_records(date, period);
+    CREATE INDEX IF NOT EXISTS idx_grade_date_period_subj ON grade_records(date, period, subject);
+    DROP INDEX IF EXISTS idx_attendance_student_date;
+    DROP INDEX IF EXISTS idx_grade_student_date;
+    CREATE INDEX IF NOT EXISTS idx_students_class ON students(class_id);
+    DROP INDEX IF EXISTS idx_students_course;
+    CREATE INDEX IF NOT EXISTS idx_students_course_class ON students(course_id, class_id);
+    CREATE INDEX IF NOT EXISTS idx_perf_results_perf_student ON performance_results(performance_id, student_id);
+    CREATE INDEX IF NOT EXISTS idx_perf_task_results_perf_task ON performance_task_results(performance_id, task_number);
+    """)
+
+    # ---- Covering-Index für die Fehlzeiten-Aggregate (Klassen-/Kursliste, Schülerdetail):
+    # SQLite liest nur den Index, nicht die Tabellenzeilen
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_att_student_cover "
+                "ON attendance_records(student_id, status, absent_minutes, late_minutes)")
+
+    # ---- Eindeutige Erfassung pro Schüler/Stunde (Grundlage für ON CONFLICT-Upserts).
+    # Doppelte Altdaten werden nicht angefasst (die Maske zeigte bisher den jüngsten, speicherte
+    # aber in den ältesten Datensatz - welcher gilt, lässt sich nicht automatisch entscheiden).
+    # Dann gibt es nur den nicht eindeutigen Index, gespeichert wird ohne Upsert
+    # (_has_unique_index) und user_version bleibt stehen, damit der nächste Start es erneut versucht.
+    records_unique = True
+    for name, old_name, table, cols in (
+        ("ux_att_sid_date_period", "idx_att_sid_date_period",
+         "attendance_records", ("student_id", "date", "period")),
+        ("ux_grade_sid_date_period_subj", "idx_grade_sid_date_period_subj",
+         "grade_records", ("student_id", "date", "period", "subject")),
+    ):
+        if _create_unique_index(cur, name, table, cols):
+            cur.execute(f"DROP INDEX IF EXISTS {old_name}")
+        else:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {old_name} ON {table}({', '.join(cols)})")
+            records_unique = False
+
+    # ---- Ein Punktwert je Abfrage/Schüler/Aufgabe (Upsert beim Speichern und Import).
+    # Wie oben: doppelte Altdaten bleiben stehen, dann ohne Upsert und ohne neue user_version.
+    if _create_unique_index(cur, "ux_perf_task_results", "performance_task_results",
+                            ("performance_id", "student_id", "task_number")):
+        cur.execute("DROP INDEX IF EXISTS idx_perf_task_results_perf_student")
+    else:
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_perf_task_results_perf_student "
+                    "ON performance_task_results(performance_id, student_id)")
+        records_unique = False
+
+    # ---- Keine Doppelbelegung im Wochenplan (date IS NULL): je Tag/Stunde höchstens ein
+    # Eintrag pro Klasse bzw. Kurs. Datierte Ausfall-/Vertretungszeilen teilen sich Tag und
+    # Stunde mit ihrer Vorlage und bleiben deshalb außen vor. Enthält eine Bestands-DB schon
+    # Doppelbelegungen, wird nichts gelöscht; die Indizes fehlen dann bis zur Bereinigung
+    # (Prüfung per _check_timetable_conflict) und user_version bleibt stehen, damit der
+    # nächste Start es erneut versucht.
+    timetable_unique = True
+    for name, col in (("ux_tt_class", "class_id"), ("ux_tt_course", "course_id")):
+        try:
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON timetable(day, period, {col}) "
+                        f"WHERE date IS NULL AND {col} IS NOT NULL")
+        except sqlite3.IntegrityError:
+            timetable_unique = False
+            logger.warning("Index %s nicht angelegt: timetable enthält Doppelbelegungen (%s)", name, col)
+
+    # ---- Case-insensitive Namenssuche (name=? COLLATE NOCASE): die name-Spalten selbst
+    # bleiben BINARY (gleiche Sortierung/Eindeutigkeit in neuen und Bestands-DBs)
+    _executescript_in_tx(cur, """
+    CREATE INDEX IF NOT EXISTS idx_classes_name_nocase ON classes(name COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS idx_courses_name_nocase ON courses(name COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS idx_subjects_name_nocase ON subjects(name COLLATE NOCASE);
+    """)
+
     # ---- Default-Notenschlüssel nur anlegen, wenn Tabelle leer
     cur.execute("SELECT COUNT(*) FROM grade_scales")
     if (cur.fetchone()[0] or 0) == 0:
@@ -380,7 +957,7 @@ def ensure_schema_migrations():
                     ("Default (86/72/58/44/20, 0.5er)", default_def))
 
     # ---- Change Log
-    cur.executescript("""
+    _executescript_in_tx(cur, """
     CREATE TABLE IF NOT EXISTS change_log(
       id INTEGER PRIMARY KEY,
       timestamp TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S','now')),
@@ -392,6 +969,7 @@ def ensure_schema_migrations():
       new_value TEXT,
       comment TEXT
     );
+    CREATE INDEX IF NOT EXISTS idx_change_log_action ON change_log(action);
     """)
 
     # ---- Default-Fächer, falls leer
@@ -404,11 +982,7 @@ def ensure_schema_migrations():
             ("Physik", "PH"),
             ("Biologie", "BI"),
         ]
-        for name, short in default_subjects:
-            try:
-                cur.execute("INSERT INTO subjects(name, short) VALUES(?, ?)", (name, short))
-            except sqlite3.IntegrityError:
-                pass
+        cur.executemany("INSERT OR IGNORE INTO subjects(name, short) VALUES(?, ?)", default_subjects)
 
     # ---- Stundenplan-Defaults (nur wenn leer)
     cur.execute("SELECT COUNT(*) AS cnt FROM timetable")
@@ -420,8 +994,35 @@ def ensure_schema_migrations():
     if cur.fetchone()[0] == 0:
         populate_default_students(cur)
 
-    conn.commit()
-    conn.close()
+    # ---- Volltextindex für die Schülersuche (Teilstring, daher Trigramme). Ohne FTS5/
+    # Trigram-Tokenizer (SQLite < 3.34) bleibt es bei LIKE, siehe _students_fts_ready().
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5("
+                    "first_name, last_name, content='students', content_rowid='id', tokenize='trigram')")
+    except sqlite3.OperationalError:
+        pass
+    else:
+        _executescript_in_tx(cur, """
+        CREATE TRIGGER IF NOT EXISTS students_fts_ai AFTER INSERT ON students BEGIN
+          INSERT INTO students_fts(rowid, first_name, last_name) VALUES (new.id, new.first_name, new.last_name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS students_fts_ad AFTER DELETE ON students BEGIN
+          INSERT INTO students_fts(students_fts, rowid, first_name, last_name)
+          VALUES ('delete', old.id, old.first_name, old.last_name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS students_fts_au AFTER UPDATE ON students BEGIN
+          INSERT INTO students_fts(students_fts, rowid, first_name, last_name)
+          VALUES ('delete', old.id, old.first_name, old.last_name);
+          INSERT INTO students_fts(rowid, first_name, last_name) VALUES (new.id, new.first_name, new.last_name);
+        END;
+        INSERT INTO students_fts(students_fts) VALUES ('rebuild');
+        """)
+
+    # Statistiken für den Query-Planer (neue Indizes) aktualisieren
+    cur.execute("ANALYZE")
+
+    if timetable_unique and records_unique:
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 def populate_default_students(cur):
     students = [
@@ -429,31 +1030,105 @@ def populate_default_students(cur):
         ("Jane", "Doe", "5f"),
         ("Peter", "Jones", "6b"),
     ]
+    class_rows = {}
+    for _, _, class_name in students:
+        norm_name = _normalize_group_name(class_name)
+        class_rows.setdefault(norm_name.lower(), (norm_name,))
+    class_ids = _bulk_get_or_create(cur, "classes", "name", class_rows.values())
+    rows = []
     for first_name, last_name, class_name in students:
-        class_id = get_or_create_class(cur, class_name)
+        class_id = class_ids.get(_normalize_group_name(class_name).lower())
         if class_id:
-            cur.execute(
-                "INSERT INTO students(first_name, last_name, class_id) VALUES(?,?,?)",
-                (first_name, last_name, class_id)
-            )
-
-# Schema sicherstellen (nachdem Helper definiert sind!)
-ensure_schema_migrations()
+            rows.append((first_name, last_name, class_id))
+    cur.executemany("INSERT INTO students(first_name, last_name, class_id) VALUES(?,?,?)", rows)
+
+# Stundenplan einer Woche (Mo-Fr, Parameter je Tag: day_idx, Wochentag, Datum) in einer Abfrage.
+# Pro (Tag, Stunde) gilt die Rangfolge:
+#   1. Eintrag mit genau diesem Datum
+#   2. letzte frühere datierte Änderung für denselben Wochentag
+#   3. Vorlage (date IS NULL) für den Wochentag
+_HOME_WEEK_SQL = (
+    "WITH week(day_idx, day_name, day_date) AS (VALUES (?,?,?),(?,?,?),(?,?,?),(?,?,?),(?,?,?)), "
+    "candidates AS ("
+    "  SELECT w.day_idx, t.period, t.id, 1 AS tier, "
+    "    ROW_NUMBER() OVER (PARTITION BY w.day_idx, t.period ORDER BY t.id) AS rn "
+    "  FROM week w JOIN timetable t ON t.date = w.day_date "
+    "  UNION ALL "
+    "  SELECT w.day_idx, t.period, t.id, 2 AS tier, "
+    "    ROW_NUMBER() OVER (PARTITION BY w.day_idx, t.period ORDER BY t.date DESC, t.id) AS rn "
+    "  FROM week w JOIN timetable t ON t.day = w.day_name AND t.date IS NOT NULL AND t.date < w.day_date "
+    "  UNION ALL "
+    "  SELECT w.day_idx, t.period, t.id, 3 AS tier, "
+    "    ROW_NUMBER() OVER (PARTITION BY w.day_idx, t.period ORDER BY t.id) AS rn "
+    "  FROM week w JOIN timetable t ON t.day = w.day_name AND t.date IS NULL"
+    "), picked AS ("
+    "  SELECT day_idx, id, ROW_NUMBER() OVER (PARTITION BY day_idx, period ORDER BY tier) AS pick "
+    "  FROM candidates WHERE rn = 1"
+    ") "
+    "SELECT p.day_idx, t.id, t.class_id, c.name AS class_name, t.course_id, d.name AS course_name, "
+    "t.subject_id, s.short AS subject_short, s.name AS subject_name, t.room, t.is_double, t.status, t.day, "
+    "t.period "
+    "FROM picked p JOIN timetable t ON t.id = p.id "
+    "LEFT JOIN classes c ON t.class_id=c.id "
+    "LEFT JOIN courses d ON t.course_id=d.id "
+    "LEFT JOIN subjects s ON t.subject_id=s.id "
+    "WHERE p.pick = 1"
+)
+
+# CSV-Import der Leistungsabfragen
+_INSERT_RESULT_SQL = ("INSERT INTO performance_results(performance_id, student_id, op_points, zp_points) "
+                      "VALUES(?,?,?,?)")
+_INSERT_TASK_RESULT_SQL = ("INSERT INTO performance_task_results(performance_id, student_id, task_number, points) "
+                           "VALUES(?,?,?,?)")
+# Doppelte Schülerzeilen in der CSV: die letzte gewinnt
+_UPSERT_TASK_RESULT_SQL = (_INSERT_TASK_RESULT_SQL + " "
+                           "ON CONFLICT(performance_id, student_id, task_number) DO UPDATE SET points=excluded.points")
+
+_LOG_CHANGE_SQL = ("INSERT INTO change_log(action, table_name, record_id, field_name, old_value, new_value, comment) "
+                   "VALUES(?,?,?,?,?,?,?)")
+
+# Schüler/Kurse bearbeiten: je Vorgang ein Statement (NULL wird als None gebunden),
+# damit der Statement-Cache der Pool-Verbindungen nur eine Variante vorhält
+_UPDATE_STUDENT_SQL = "UPDATE students SET first_name=?, last_name=?, class_id=?, course_id=? WHERE id=?"
+_INSERT_STUDENT_SQL = "INSERT INTO students(first_name, last_name, class_id, course_id) VALUES(?,?,?,?)"
+_SET_COURSE_LEADER_SQL = "UPDATE courses SET leader_id=? WHERE id=?"
+_UPSERT_COURSE_SQL = ("INSERT INTO courses(name, class_id, leader_id) VALUES(?, NULL, ?) "
+                      "ON CONFLICT(name) DO UPDATE SET leader_id=COALESCE(excluded.leader_id, leader_id)")
+# Existenzprüfung von Klasse/Kurs bzw. Lehrer direkt im UPDATE (rowcount 0 → Nachprüfen)
+_ENROLL_STUDENT_SQL = ("UPDATE students SET class_id=?1, course_id=?2 WHERE id=?3 "
+                       "AND EXISTS(SELECT 1 FROM classes WHERE id=?1) "
+                       "AND (?2 IS NULL OR EXISTS(SELECT 1 FROM courses WHERE id=?2))")
+_ASSIGN_COURSE_LEADER_SQL = ("UPDATE courses SET leader_id=?1 WHERE id=?2 "
+                             "AND (?1 IS NULL OR EXISTS(SELECT 1 FROM teachers WHERE id=?1))")
+_ASSIGN_CLASS_TEACHER_SQL = ("UPDATE classes SET teacher_id=?1 WHERE id=?2 "
+                             "AND (?1 IS NULL OR EXISTS(SELECT 1 FROM teachers WHERE id=?1))")
+
+# Mehrfach genutzte Fehlerseiten, einmal vorab kodiert (_send_html nimmt auch bytes)
+_TIMETABLE_CONFLICT_HTML = ("<h1>409 Conflict</h1><p>A lesson for this class/course already exists at this time.</p>"
+                            "<p><a href='/admin/timetable'>Back</a></p>").encode("utf-8")
+_INVALID_ID_HTML = "<h1>400</h1><p>Ungültige ID.</p>".encode("utf-8")
 
 # =========================
 # HTTP Handler
 # =========================
 class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
+    # Gepufferter Ausgabestrom: Header und Body gehen gesammelt raus (Flush nach jedem Request)
+    wbufsize = -1
+    # Keep-Alive: der Browser nutzt die TCP-Verbindung für Folge-Requests (CSS, Redirects)
+    # weiter. Jede Antwort braucht dafür Content-Length oder Chunked-Encoding (render()).
+    protocol_version = "HTTP/1.1"
+    timeout = 30  # Sekunden; ungenutzte Keep-Alive-Verbindungen geben ihren Thread wieder frei
+
     def _post_admin_timetable_delete(self):
         data = self._parse_post()
-        tid = int(data.get('id', '0') or '0')
+        tid = _parse_int(data, 'id')
         if tid <= 0:
-            return self._send_html("<h1>400</h1><p>Ungültige ID.</p>", status=400)
+            return self._send_html(_INVALID_ID_HTML, status=400)
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("DELETE FROM timetable WHERE id=?", (tid,))
+            self._log_change('timetable', tid, 'delete', '', '', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('timetable', tid, 'delete', '', '', 'manual', None)
         self._redirect('/admin/timetable')
 
     NAV_BAR = """
@@ -471,37 +1146,84 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
 
     # ---------- HTTP helpers ----------
     def render(self, template_name, context={}):
+        """
+        Template direkt in den (gepufferten) Ausgabestrom schreiben, ohne das ganze
+        HTML vorher als str/bytes zu materialisieren. Die Länge ist vorab unbekannt:
+        HTTP/1.1-Clients bekommen Chunked-Encoding (Verbindung bleibt offen).
+        HTTP/1.0 kennt kein Chunked-Encoding; ein Abbruch wäre dort vom regulären
+        Antwortende nicht zu unterscheiden, daher wird erst komplett gerendert
+        (Template-Fehler → 500-Seite).
+        """
         template = template_env.get_template(template_name)
-        html = template.render(context)
-        self._send_html(html)
+        if self.request_version == "HTTP/1.0":
+            return self._send_html(template.render(context))
+        self._response_started = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        stream = template.stream(context)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        write = self.wfile.write
+        parts, size = [], 0
+        try:
+            for part in stream:
+                parts.append(part); size += len(part)
+                if size >= 16384:  # Chunks von ~16 KB statt einem pro Template-Ausdruck
+                    data = "".join(parts).encode("utf-8")
+                    write(b"%x\r\n%s\r\n" % (len(data), data))
+                    parts, size = [], 0
+        except BaseException:
+            # Kein End-Chunk: der Client sieht eine abgebrochene Übertragung statt einer
+            # scheinbar vollständigen Seite
+            self.close_connection = True
+            raise
+        data = "".join(parts).encode("utf-8")
+        if data:
+            write(b"%x\r\n%s\r\n" % (len(data), data))
+        write(b"0\r\n\r\n")
+
+    def _render_rows(self, conn, template_name, context, rows):
+        """
+        Wie render(), aber rows darf ein noch offener Cursor sein: das Template liest die
+        Zeilen direkt beim Ausgeben. Cursor und Verbindung werden erst danach geschlossen.
+        """
+        try:
+            self.render(template_name, context)
+        finally:
+            if isinstance(rows, sqlite3.Cursor):
+                rows.close()
+            conn.close()
 
-    def _send_html(self, html: str, status: int = 200, headers: dict | None = None):
+    def _send_html(self, html: str | bytes, status: int = 200, headers: dict | None = None):
+        body = html if isinstance(html, bytes) else html.encode("utf-8")
         self.send_response(status)
         self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
         if headers:
             for k,v in headers.items():
                 self.send_header(k, v)
         self.end_headers()
-        self.wfile.write(html.encode("utf-8"))
+        self.wfile.write(body)
 
     def _redirect(self, url: str):
         self.send_response(303)  # See Other
         self.send_header("Location", url)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode("utf-8"))
+        self.wfile.write(body)
 
     def _parse_json_post(self):
-        length = int(self.headers.get("Content-Length", "0") or "0")
-        if length == 0:
+        if not self._post_body:
             return {}
-        raw_data = self.rfile.read(length)
         try:
-            return json.loads(raw_data)
+            return json.loads(self._post_body)
         except json.JSONDecodeError:
             return {}
 
@@ -509,140 +1231,112 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         parsed = urllib.parse.urlparse(self.path)
         return parsed.path, urllib.parse.parse_qs(parsed.query)
 
+    def _read_post_body(self):
+        """Header und Body eines POST genau einmal lesen (in do_POST)."""
+        self._post_ctype = self.headers.get("Content-Type", "")
+        length = int(self.headers.get("Content-Length", "0") or "0")
+        self._post_body = self.rfile.read(length) if length > 0 else b""
+
     def _parse_post(self):
-        ctype = self.headers.get("Content-Type","")
-        length = int(self.headers.get("Content-Length","0") or "0")
-        raw = self.rfile.read(length) if length>0 else b""
+        ctype = self._post_ctype
         if "application/x-www-form-urlencoded" in ctype or "multipart/form-data" in ctype:
-            data = urllib.parse.parse_qs(raw.decode("utf-8"), keep_blank_values=True)
-            return {k: v[0] for k,v in data.items()}
+            data = {}
+            for k, v in _fast_parse_qsl(self._post_body):
+                data.setdefault(k, v)  # erster Wert gewinnt (wie zuvor parse_qs()[k][0])
+            return data
         return {}
 
     # ---------- GET ----------
+    # Routing-Tabellen: Pfad -> Handler-Methode (einmal pro Klasse aufgebaut)
+    GET_ROUTES = {
+        "/classes": "_handle_classes",
+        "/courses": "_handle_courses",
+        "/class": "_handle_class_detail",
+        "/course": "_handle_course_detail",
+        "/students": "_handle_students",
+        "/student": "_handle_student_detail",
+        "/admin": "_handle_admin",
+        "/admin/subjects": "_handle_admin_subjects",
+        "/admin/teachers": "_handle_admin_teachers",
+        "/admin/classes": "_handle_admin_classes",
+        "/admin/timetable": "_handle_admin_timetable",
+        "/admin/timetable/edit": "_handle_admin_timetable_edit",
+        "/admin/courses": "_handle_admin_courses",
+        "/export_import": "_handle_export_import",
+        "/performance": "_handle_performance_detail",
+        "/leistung": "_handle_leistungsabfragen",
+        "/leistungsabfragen": "_handle_leistungsabfragen",
+        "/performance/download": "_handle_performance_download",
+        "/grade_scales": "_handle_grade_scales",
+        "/admin/log": "_handle_admin_log",
+        "/admin/attendance": "_handle_admin_attendance",
+        "/capture_data": "_handle_capture_data",
+    }
+    POST_ROUTES = {
+        "/enroll/update": "_post_enroll_update",
+        "/student/save": "_post_student_save",
+        "/course/create": "_post_course_create",
+        "/student/create": "_post_student_create",
+        "/student/delete": "_post_student_delete",
+        "/admin/subject/create": "_post_admin_subject_create",
+        "/admin/subject/delete": "_post_admin_subject_delete",
+        "/admin/teacher/create": "_post_admin_teacher_create",
+        "/admin/teacher/delete": "_post_admin_teacher_delete",
+        "/admin/timetable/create": "_post_admin_timetable_create",
+        "/admin/timetable/update": "_post_admin_timetable_update",
+        "/admin/timetable/delete": "_post_admin_timetable_delete",
+        "/class/assign_teacher": "_post_class_assign_teacher",
+        "/course/assign_leader": "_post_course_assign_leader",
+        "/admin/course/create": "_post_admin_course_create",
+        "/admin/course/delete": "_post_admin_course_delete",
+        "/performance/create": "_post_performance_create",
+        "/performance/import": "_post_performance_import",
+        "/performance/delete": "_post_performance_delete",
+        "/grade_scale/create": "_post_grade_scale_create",
+        "/performance/assign_scale": "_post_assign_grade_scale",
+        "/performance/update_override": "_post_update_grade_override",
+        "/performance/update_student_scores": "_post_performance_update_student_scores",
+        "/attendance/create": "_post_attendance_create",
+        "/capture_data/save": "_post_capture_data_save",
+        "/lesson/update_status": "_post_lesson_update_status",
+        "/lesson/uncancel": "_post_lesson_uncancel",
+    }
+
+    def _send_error_page(self, exc):
+        # Bricht ein gestreamtes Template mittendrin ab, sind Header schon raus:
+        # dann keine zweite Antwort anhängen, sondern die Verbindung schließen.
+        # Auch sonst nach einem Fehler schließen: der Request-Body ist evtl. ungelesen.
+        self.close_connection = True
+        if self._response_started:
+            return
+        self._send_html(f"<h1>500</h1><pre>{html_escape(str(exc))}</pre>", status=500)
+
     def do_GET(self):
+        self._response_started = False
         path, params = self._parse_query()
         try:
-            if path == "/classes":
-                self._handle_classes(params)
-            elif path == "/courses":
-                self._handle_courses(params)
-            elif path == "/class":
-                self._handle_class_detail(params)
-            elif path == "/course":
-                self._handle_course_detail(params)
-            elif path == "/students":
-                self._handle_students(params)
-            elif path == "/student":
-                self._handle_student_detail(params)
-            elif path == "/admin":
-                self._handle_admin(params)
-            elif path == "/admin/subjects":
-                self._handle_admin_subjects(params)
-            elif path == "/admin/teachers":
-                self._handle_admin_teachers(params)
-            elif path == "/admin/classes":
-                self._handle_admin_classes(params)
-            elif path == "/admin/timetable":
-                self._handle_admin_timetable(params)
-            elif path == "/admin/timetable/edit":
-                self._handle_admin_timetable_edit(params)
-            elif path == "/admin/courses":
-                self._handle_admin_courses(params)
-            elif path == "/export_import":
-                self._handle_export_import(params)
-            elif path == "/performance":
-                self._handle_performance_detail(params)
-            elif path == "/leistung" or path == "/leistungsabfragen":
-                self._handle_leistungsabfragen(params)
-            elif path == "/performance/download":
-                self._handle_performance_download(params)
-            elif path == "/grade_scales":
-                self._handle_grade_scales(params)
-            elif path == "/admin/log":
-                self._handle_admin_log(params)
-            elif path == "/admin/attendance":
-                self._handle_admin_attendance(params)
-            elif path == "/capture_data":
-                self._handle_capture_data(params)
-            else:
-                self._handle_home(params)
+            name = self.GET_ROUTES.get(path)
+            (getattr(self, name) if name else self._handle_home)(params)
         except Exception as exc:
             # Fehler ins Log schreiben
-            with open("server.log", "a", encoding="utf-8") as logf:
-                import traceback
-                logf.write(f"[{datetime.datetime.now()}] GET {self.path}\n")
-                logf.write(traceback.format_exc())
-                logf.write("\n")
-            self._send_html(f"<h1>500</h1><pre>{html_escape(str(exc))}</pre>", status=500)
+            logger.exception("GET %s", self.path)
+            self._send_error_page(exc)
 
     # ---------- POST ----------
     def do_POST(self):
+        self._response_started = False
         path, _ = self._parse_query()
         try:
-            if path == "/enroll/update":
-                self._post_enroll_update()
-            elif path == "/student/save":
-                self._post_student_save()
-            elif path == "/course/create":
-                self._post_course_create()
-            elif path == "/student/create":
-                self._post_student_create()
-            elif path == "/student/delete":
-                self._post_student_delete()
-            elif path == "/admin/subject/create":
-                self._post_admin_subject_create()
-            elif path == "/admin/subject/delete":
-                self._post_admin_subject_delete()
-            elif path == "/admin/teacher/create":
-                self._post_admin_teacher_create()
-            elif path == "/admin/teacher/delete":
-                self._post_admin_teacher_delete()
-            elif path == "/admin/timetable/create":
-                self._post_admin_timetable_create()
-            elif path == "/admin/timetable/update":
-                self._post_admin_timetable_update()
-            elif path == "/admin/timetable/delete":
-                self._post_admin_timetable_delete()
-            elif path == "/class/assign_teacher":
-                self._post_class_assign_teacher()
-            elif path == "/course/assign_leader":
-                self._post_course_assign_leader()
-            elif path == "/admin/course/create":
-                self._post_admin_course_create()
-            elif path == "/admin/course/delete":
-                self._post_admin_course_delete()
-            elif path == "/performance/create":
-                self._post_performance_create()
-            elif path == "/performance/import":
-                self._post_performance_import()
-            elif path == "/performance/delete":
-                self._post_performance_delete()
-            elif path == "/grade_scale/create":
-                self._post_grade_scale_create()
-            elif path == "/performance/assign_scale":
-                self._post_assign_grade_scale()
-            elif path == "/performance/update_override":
-                self._post_update_grade_override()
-            elif path == "/performance/update_student_scores":
-                self._post_performance_update_student_scores()
-            elif path == "/attendance/create":
-                self._post_attendance_create()
-            elif path == "/capture_data/save":
-                self._post_capture_data_save()
-            elif path == "/lesson/update_status":
-                self._post_lesson_update_status()
-            elif path == "/lesson/uncancel":
-                self._post_lesson_uncancel()
+            self._read_post_body()
+            name = self.POST_ROUTES.get(path)
+            if name:
+                getattr(self, name)()
             else:
                 self._send_html("<h1>404</h1><p>Route nicht gefunden.</p>", status=404)
         except Exception as exc:
             # Fehler ins Log schreiben
-            with open("server.log", "a", encoding="utf-8") as logf:
-                import traceback
-                logf.write(f"[{datetime.datetime.now()}] POST {self.path}\n")
-                logf.write(traceback.format_exc())
-                logf.write("\n")
-            self._send_html(f"<h1>500</h1><pre>{html_escape(str(exc))}</pre>", status=500)
+            logger.exception("POST %s", self.path)
+            self._send_error_page(exc)
     # ---------- Views ----------
     def _handle_home(self, params):
         try:
@@ -667,54 +1361,29 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         weeks_since_start = delta_days // 7
         sw = (weeks_since_start % 6) + 1
         dates = [start_monday + datetime.timedelta(days=i) for i in range(5)]
-        date_strs = [d.strftime('%Y-%m-%d') for d in dates]
+        date_strs = [d.isoformat() for d in dates]
         day_labels = ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag']
 
+        week_params = []
+        for day_idx, date_str in enumerate(date_strs):
+            week_params.extend([day_idx, day_labels[day_idx], date_str])
         conn = get_db_connection(); cur = conn.cursor()
+        rows = cur.execute(
+            _HOME_WEEK_SQL,
+            week_params,
+        ).fetchall()
+        conn.close()
+
+        # sqlite3.Row direkt ans Template; abgeleitete Werte (URL) liegen in eigenen Dicts
+        found = {(r['day_idx'], r['period']): r for r in rows}
+
         schedule_entries = {}
-        for day_idx, date_str in enumerate(date_strs):
+        for day_idx in range(len(date_strs)):
             day_name = day_labels[day_idx]
             prev_period = None
-            period_list = [slot['period'] for slot in SCHEDULE_PATTERN if 'period' in slot]
-            for slot in SCHEDULE_PATTERN:
-                if 'period' not in slot:
-                    continue
-                period = slot['period']
-                # 1. Suche nach Eintrag, der in dieser Periode startet
-                row = cur.execute(
-                    "SELECT t.id, t.class_id, c.name AS class_name, t.course_id, d.name AS course_name, "
-                    "t.subject_id, s.short AS subject_short, s.name AS subject_name, t.room, t.is_double, t.status, t.day "
-                    "FROM timetable t "
-                    "LEFT JOIN classes c ON t.class_id=c.id "
-                    "LEFT JOIN courses d ON t.course_id=d.id "
-                    "LEFT JOIN subjects s ON t.subject_id=s.id "
-                    "WHERE t.date=? AND t.period=?",
-                    (date_str, period),
-                ).fetchone()
-                if not row:
-                    row = cur.execute(
-                        "SELECT t.id, t.class_id, c.name AS class_name, t.course_id, d.name AS course_name, "
-                        "t.subject_id, s.short AS subject_short, s.name AS subject_name, t.room, t.is_double, t.status, t.day "
-                        "FROM timetable t "
-                        "LEFT JOIN classes c ON t.class_id=c.id "
-                        "LEFT JOIN courses d ON t.course_id=d.id "
-                        "LEFT JOIN subjects s ON t.subject_id=s.id "
-                        "WHERE t.date IS NOT NULL AND t.date < ? AND t.day=? AND t.period=? "
-                        "ORDER BY t.date DESC LIMIT 1",
-                        (date_str, day_name, period),
-                    ).fetchone()
-                if not row:
-                    row = cur.execute(
-                        "SELECT t.id, t.class_id, c.name AS class_name, t.course_id, d.name AS course_name, "
-                        "t.subject_id, s.short AS subject_short, s.name AS subject_name, t.room, t.is_double, t.status, t.day "
-                        "FROM timetable t "
-                        "LEFT JOIN classes c ON t.class_id=c.id "
-                        "LEFT JOIN courses d ON t.course_id=d.id "
-                        "LEFT JOIN subjects s ON t.subject_id=s.id "
-                        "WHERE t.date IS NULL AND t.day=? AND t.period=?",
-                        (day_name, period),
-                    ).fetchone()
-                # 2. Falls kein Eintrag, prüfe ob vorherige Periode eine Doppelstunde ist (und Tag passt)
+            for period in _schedule_periods():
+                row = found.get((day_idx, period))
+                # Falls kein Eintrag, prüfe ob vorherige Periode eine Doppelstunde ist (und Tag passt)
                 if not row and prev_period is not None:
                     prev_row = schedule_entries.get((day_idx, prev_period))
                     if prev_row and prev_row['is_double']:
@@ -724,38 +1393,18 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
                 if row:
                     schedule_entries[(day_idx, period)] = row
                 prev_period = period
-        conn.close()
 
-        # Prepare data for the template
+        # Prepare data for the template (Label wird im Template zusammengesetzt).
+        # URL pro Schlüssel, da eine Doppelstunde unter zwei Perioden (mit eigener URL) steht.
+        schedule_urls = {}
         for key, entry in schedule_entries.items():
-            # Convert the sqlite3.Row object to a mutable dictionary
-            entry_dict = dict(entry)
-
-            group_name = entry_dict['course_name'] or entry_dict['class_name']
-
-            params = {
-                'date': date_strs[key[0]],
-                'period': key[1],
-                'subject_id': entry_dict['subject_id'],
-                'class_id': entry_dict['class_id'],
-                'course_id': entry_dict['course_id'],
-                'timetable_id': entry_dict['id'],
-            }
-            # Filter out None values
-            params = {k: v for k, v in params.items() if v is not None}
-
-            entry_dict['url'] = f"/capture_data?{urllib.parse.urlencode(params)}"
-
-            subj = entry_dict['subject_short'] if entry_dict['subject_short'] else (entry_dict['subject_name'] if entry_dict['subject_name'] else '')
-            room = entry_dict['room'] or ''
-            parts = []
-            if group_name: parts.append(group_name)
-            if subj: parts.append(subj)
-            if room: parts.append(room)
-            entry_dict['label'] = ' - '.join(parts)
-
-            # Replace the original Row object with the dictionary
-            schedule_entries[key] = entry_dict
+            # Nur Datum und Integer-IDs: kein urlencode nötig
+            url = f"/capture_data?date={date_strs[key[0]]}&period={key[1]}"
+            for name, value in (('subject_id', entry['subject_id']), ('class_id', entry['class_id']),
+                                ('course_id', entry['course_id']), ('timetable_id', entry['id'])):
+                if value is not None:
+                    url += f"&{name}={value}"
+            schedule_urls[key] = url
 
         current_day_idx = -1
         if week_offset == 0:
@@ -766,8 +1415,9 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "sw": sw,
             "dates": dates,
             "day_labels": day_labels,
-            "schedule_pattern": SCHEDULE_PATTERN,
+            "schedule_pattern": _schedule_pattern(),
             "schedule_entries": schedule_entries,
+            "schedule_urls": schedule_urls,
             "week_offset": week_offset,
             "current_day_idx": current_day_idx,
         }
@@ -806,16 +1456,23 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         subject_row = cur.execute("SELECT name, short FROM subjects WHERE id=?", (subject_id,)).fetchone()
         subject_name = subject_row['name'] if subject_row else 'Unknown Subject'
 
-        # Fetch existing data for this lesson
-        existing_attendance_rows = cur.execute("SELECT student_id, status, absent_minutes, late_minutes FROM attendance_records WHERE date=? AND period=?", (date, period)).fetchall()
+        # Fetch existing data for this lesson (Anwesenheit und Noten in einer Abfrage)
         existing_attendance = {}
-        for r in existing_attendance_rows:
-            d = dict(r)
-            if (d['late_minutes'] or 0) > 0:
-                d['status'] = 'late'
-            existing_attendance[d['student_id']] = d
-        
-        existing_grades = {r['student_id']: r for r in cur.execute("SELECT student_id, grade, comment FROM grade_records WHERE date=? AND period=? AND subject=?", (date, period, subject_name)).fetchall()}
+        existing_grades = {}
+        for kind, sid, status, absent_minutes, late_minutes, grade, comment in cur.execute(
+            "SELECT 'a', student_id, status, absent_minutes, late_minutes, NULL, NULL "
+            "FROM attendance_records WHERE date=? AND period=? "
+            "UNION ALL "
+            "SELECT 'g', student_id, NULL, NULL, NULL, grade, comment "
+            "FROM grade_records WHERE date=? AND period=? AND subject=?",
+            (date, period, date, period, subject_name),
+        ):
+            if kind == 'a':
+                if (late_minutes or 0) > 0:
+                    status = 'late'
+                existing_attendance[sid] = _Attendance(status, absent_minutes, late_minutes)
+            else:
+                existing_grades[sid] = _Grade(grade, comment)
 
         conn.close()
 
@@ -861,64 +1518,85 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
                 except (ValueError, IndexError):
                     continue
 
+        att_rows, grade_rows, grade_deletes = [], [], []
+        for sid in student_ids:
+            # --- Attendance ---
+            attendance_val = data.get(f'attendance_{sid}')
+            if attendance_val:
+                status = 'present'
+                late_minutes = 0
+                if attendance_val == 'absent':
+                    status = 'absent'
+                elif attendance_val.startswith('late_'):
+                    try:
+                        late_minutes = int(attendance_val.split('_')[1])
+                    except (ValueError, IndexError):
+                        late_minutes = 0
+
+                absent_minutes = LESSON_MINUTES if status == 'absent' else 0
+                att_rows.append((sid, date, period, status, absent_minutes, late_minutes))
+
+            # --- Grade and Comment ---
+            grade_val = data.get(f'grade_{sid}')
+            comment_val = data.get(f'comment_{sid}')
+            if grade_val or comment_val:
+                try:
+                    grade = float(grade_val) if grade_val and grade_val.strip() else None
+                except (ValueError, TypeError):
+                    continue # Gracefully skip if grade is not a valid float
+                grade_rows.append((sid, date, period, 'spontaneous', subject_name, grade, comment_val or None))
+            else:
+                # If no grade/comment is submitted, but a record exists, delete it.
+                grade_deletes.append((sid, date, period, subject_name))
+
         with conn:
-            for sid in student_ids:
-                # --- Attendance ---
-                attendance_val = data.get(f'attendance_{sid}')
-
-                # Check for existing record
-                cur.execute("SELECT id FROM attendance_records WHERE student_id=? AND date=? AND period=?", (sid, date, period))
-                existing_att_id = cur.fetchone()
-
-                if attendance_val:
-                    status = 'present'
-                    late_minutes = 0
-                    if attendance_val == 'absent':
-                        status = 'absent'
-                    elif attendance_val.startswith('late_'):
-                        try:
-                            late_minutes = int(attendance_val.split('_')[1])
-                        except (ValueError, IndexError):
-                            late_minutes = 0
-
-                    absent_minutes = LESSON_MINUTES if status == 'absent' else 0
-
-                    if existing_att_id:
+            if _has_unique_index(cur, "ux_att_sid_date_period"):
+                cur.executemany(
+                    "INSERT INTO attendance_records (student_id, date, period, status, absent_minutes, late_minutes) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(student_id, date, period) DO UPDATE SET "
+                    "status=excluded.status, absent_minutes=excluded.absent_minutes, late_minutes=excluded.late_minutes",
+                    att_rows,
+                )
+            else:
+                # Ohne eindeutigen Index (doppelte Altdaten): alle Treffer aktualisieren, sonst einfügen
+                for sid, date_, period_, status, absent_minutes, late_minutes in att_rows:
+                    cur.execute(
+                        "UPDATE attendance_records SET status=?, absent_minutes=?, late_minutes=? "
+                        "WHERE student_id=? AND date=? AND period=?",
+                        (status, absent_minutes, late_minutes, sid, date_, period_),
+                    )
+                    if cur.rowcount == 0:
                         cur.execute(
-                            "UPDATE attendance_records SET status=?, absent_minutes=?, late_minutes=? WHERE id=?",
-                            (status, absent_minutes, late_minutes, existing_att_id['id'])
+                            "INSERT INTO attendance_records (student_id, date, period, status, absent_minutes, late_minutes) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (sid, date_, period_, status, absent_minutes, late_minutes),
                         )
-                    else:
+            if _has_unique_index(cur, "ux_grade_sid_date_period_subj"):
+                cur.executemany(
+                    "INSERT INTO grade_records (student_id, date, period, type, subject, grade, comment) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(student_id, date, period, subject) DO UPDATE SET "
+                    "grade=excluded.grade, comment=excluded.comment",
+                    grade_rows,
+                )
+            else:
+                for sid, date_, period_, type_, subject, grade, comment in grade_rows:
+                    cur.execute(
+                        "UPDATE grade_records SET grade=?, comment=? "
+                        "WHERE student_id=? AND date=? AND period=? AND subject=?",
+                        (grade, comment, sid, date_, period_, subject),
+                    )
+                    if cur.rowcount == 0:
                         cur.execute(
-                            "INSERT INTO attendance_records (student_id, date, period, status, absent_minutes, late_minutes) VALUES (?, ?, ?, ?, ?, ?)",
-                            (sid, date, period, status, absent_minutes, late_minutes)
+                            "INSERT INTO grade_records (student_id, date, period, type, subject, grade, comment) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (sid, date_, period_, type_, subject, grade, comment),
                         )
-
-                # --- Grade and Comment ---
-                grade_val = data.get(f'grade_{sid}')
-                comment_val = data.get(f'comment_{sid}')
-
-                cur.execute("SELECT id FROM grade_records WHERE student_id=? AND date=? AND period=? AND subject=?", (sid, date, period, subject_name))
-                existing_grade_id = cur.fetchone()
-
-                if grade_val or comment_val:
-                    try:
-                        grade = float(grade_val) if grade_val and grade_val.strip() else None
-                        if existing_grade_id:
-                            cur.execute(
-                                "UPDATE grade_records SET grade=?, comment=? WHERE id=?",
-                                (grade, comment_val or None, existing_grade_id['id'])
-                            )
-                        else:
-                            cur.execute(
-                                "INSERT INTO grade_records (student_id, date, period, type, subject, grade, comment) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                (sid, date, period, 'spontaneous', subject_name, grade, comment_val or None)
-                            )
-                    except (ValueError, TypeError):
-                        pass # Gracefully skip if grade is not a valid float
-                elif existing_grade_id:
-                    # If no grade/comment is submitted, but a record exists, delete it.
-                    cur.execute("DELETE FROM grade_records WHERE id=?", (existing_grade_id['id'],))
+            cur.executemany(
+                "DELETE FROM grade_records WHERE student_id=? AND date=? AND period=? AND subject=?",
+                grade_deletes,
+            )
 
         conn.close()
         self._redirect(f"/?msg=Daten+fuer+{date}+gespeichert")
@@ -992,15 +1670,32 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         direction = (params.get("dir", ["asc"])[0] or "asc").lower()
         direction = "desc" if direction == "desc" else "asc"
 
+        # Sortierung in SQL; Gleichstände bleiben nach c.id geordnet wie beim stabilen list.sort
+        order_by = ", ".join(f"{term} {direction.upper()}" for term in CLASS_SORT_COLUMNS.get(sort, CLASS_SORT_COLUMNS["name"]))
+
         conn = get_db_connection(); cur = conn.cursor()
 
-        cur.execute("SELECT COUNT(*) FROM classes"); total_classes = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM courses"); total_courses = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM students"); total_students = cur.fetchone()[0]
+        total_classes, total_courses, total_students = cur.execute(
+            "SELECT (SELECT COUNT(*) FROM classes), (SELECT COUNT(*) FROM courses), (SELECT COUNT(*) FROM students)"
+        ).fetchone()
 
+        # Alle Kennzahlen in einer Abfrage; jede Tabelle wird vorab pro Klasse aggregiert,
+        # damit sich Noten- und Anwesenheitszeilen im JOIN nicht gegenseitig vervielfachen.
         rows = cur.execute(
-            "SELECT c.id, c.name, c.teacher_id, t.short AS teacher_short, t.name AS teacher_name "
-            "FROM classes c LEFT JOIN teachers t ON c.teacher_id = t.id"
+            "SELECT c.id, c.name, c.teacher_id, t.short AS teacher_short, t.name AS teacher_name, "
+            "COALESCE(sc.student_count, 0) AS student_count, ga.avg_grade, "
+            "COALESCE(aa.absent_minutes, 0) AS absent_minutes, COALESCE(aa.late_minutes, 0) AS late_minutes "
+            "FROM classes c LEFT JOIN teachers t ON c.teacher_id = t.id "
+            "LEFT JOIN (SELECT class_id, COUNT(*) AS student_count FROM students GROUP BY class_id) sc "
+            "  ON sc.class_id = c.id "
+            "LEFT JOIN (SELECT s.class_id, AVG(g.grade) AS avg_grade FROM grade_records g "
+            "  JOIN students s ON g.student_id = s.id GROUP BY s.class_id) ga ON ga.class_id = c.id "
+            "LEFT JOIN (SELECT s.class_id, "
+            "  SUM(CASE WHEN a.status='absent' THEN a.absent_minutes ELSE 0 END) AS absent_minutes, "
+            "  SUM(a.late_minutes) AS late_minutes "
+            "  FROM attendance_records a JOIN students s ON a.student_id = s.id GROUP BY s.class_id) aa "
+            "  ON aa.class_id = c.id "
+            f"ORDER BY {order_by}, c.id"
         ).fetchall()
 
         teachers_list = get_all_teachers(cur)
@@ -1008,24 +1703,10 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         data = []
         for r in rows:
             class_id = r["id"]
-            student_count = cur.execute("SELECT COUNT(*) FROM students WHERE class_id=?", (class_id,)).fetchone()[0]
-            cur.execute(
-                "SELECT AVG(g.grade) FROM grade_records g "
-                "JOIN students s ON g.student_id = s.id WHERE s.class_id=?", (class_id,)
-            )
-            avg_grade = cur.fetchone()[0] or None
-            cur.execute(
-                "SELECT COALESCE(SUM(a.absent_minutes),0) FROM attendance_records a JOIN students s ON a.student_id = s.id "
-                "WHERE s.class_id=? AND a.status='absent'",
-                (class_id,),
-            )
-            absent_minutes = cur.fetchone()[0] or 0
-            cur.execute(
-                "SELECT COALESCE(SUM(a.late_minutes),0) FROM attendance_records a "
-                "JOIN students s ON a.student_id = s.id WHERE s.class_id=?",
-                (class_id,),
-            )
-            total_late_minutes = cur.fetchone()[0] or 0
+            student_count = r["student_count"]
+            avg_grade = r["avg_grade"] or None
+            absent_minutes = r["absent_minutes"] or 0
+            total_late_minutes = r["late_minutes"] or 0
 
             fehlstunden = (absent_minutes or 0) / float(LESSON_MINUTES)
             teacher_label = (r["teacher_short"] or "") + ((" (" + r["teacher_name"] + ")") if r["teacher_name"] else "")
@@ -1044,30 +1725,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
 
         conn.close()
 
-        key_map = {
-            "name": lambda x: (x["name"] or "").lower(),
-            "size": lambda x: x["student_count"],
-            "avg":  lambda x: (x["avg_grade"] if x["avg_grade"] is not None else 9999.0),
-            "fehl": lambda x: x["fehlstunden"],
-            "late": lambda x: x["verspaetung_min"],
-            "id":   lambda x: x["id"],
-        }
-        keyfunc = key_map.get(sort, key_map["name"])
-        reverse = True if direction == "desc" else False
-        data.sort(key=keyfunc, reverse=reverse)
-
-        def get_sort_link(col):
-            next_dir = "desc" if (sort == col and direction == "asc") else "asc"
-            return f"/classes?sort={col}&dir={next_dir}"
-
-        sort_links = {
-            "id": get_sort_link("id"),
-            "name": get_sort_link("name"),
-            "size": get_sort_link("size"),
-            "avg": get_sort_link("avg"),
-            "fehl": get_sort_link("fehl"),
-            "late": get_sort_link("late"),
-        }
+        sort_links = _sort_links(_CLASS_SORT_LINKS, sort, direction)
 
         context = {
             "total_classes": total_classes,
@@ -1085,83 +1743,49 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         direction = (params.get("dir", ["asc"])[0] or "asc").lower()
         direction = "desc" if direction == "desc" else "asc"
 
+        order_by = ", ".join(f"{term} {direction.upper()}" for term in COURSE_SORT_COLUMNS.get(sort, COURSE_SORT_COLUMNS["name"]))
+
         conn = get_db_connection(); cur = conn.cursor()
 
+        # Wie bei den Klassen: pro Tabelle vorab je Kurs aggregieren, sortiert wird in SQL
         rows = cur.execute(
-            "SELECT d.id, d.name, d.leader_id, t.short AS leader_short, t.name AS leader_name, "
-            "(SELECT COUNT(*) FROM students s WHERE s.course_id = d.id) AS student_count "
-            "FROM courses d LEFT JOIN teachers t ON d.leader_id = t.id"
+            f"SELECT d.id, d.name, d.leader_id, t.short AS leader_short, t.name AS leader_name, {_LEADER_SQL} AS leader, "
+            "COALESCE(sc.student_count, 0) AS student_count, ga.avg_grade, "
+            "COALESCE(aa.absent_minutes, 0) AS absent_minutes, COALESCE(aa.late_minutes, 0) AS late_minutes "
+            "FROM courses d LEFT JOIN teachers t ON d.leader_id = t.id "
+            "LEFT JOIN (SELECT course_id, COUNT(*) AS student_count FROM students "
+            "  WHERE course_id IS NOT NULL GROUP BY course_id) sc ON sc.course_id = d.id "
+            "LEFT JOIN (SELECT s.course_id, AVG(g.grade) AS avg_grade FROM grade_records g "
+            "  JOIN students s ON g.student_id = s.id WHERE s.course_id IS NOT NULL GROUP BY s.course_id) ga "
+            "  ON ga.course_id = d.id "
+            "LEFT JOIN (SELECT s.course_id, "
+            "  SUM(CASE WHEN a.status='absent' THEN a.absent_minutes ELSE 0 END) AS absent_minutes, "
+            "  SUM(a.late_minutes) AS late_minutes "
+            "  FROM attendance_records a JOIN students s ON a.student_id = s.id "
+            "  WHERE s.course_id IS NOT NULL GROUP BY s.course_id) aa ON aa.course_id = d.id "
+            f"ORDER BY {order_by}, d.id"
         ).fetchall()
 
         data = []
         for r in rows:
-            course_id = r["id"]
-            cur.execute(
-                "SELECT AVG(g.grade) FROM grade_records g JOIN students s ON g.student_id=s.id WHERE s.course_id=?",
-                (course_id,),
-            )
-            avg_grade = cur.fetchone()[0] or None
-            cur.execute(
-                "SELECT COALESCE(SUM(a.absent_minutes),0) FROM attendance_records a JOIN students s ON a.student_id = s.id "
-                "WHERE s.course_id=? AND a.status='absent'",
-                (course_id,),
-            )
-            absent_minutes = cur.fetchone()[0] or 0
-            cur.execute(
-                "SELECT COALESCE(SUM(a.late_minutes),0) FROM attendance_records a JOIN students s ON a.student_id = s.id "
-                "WHERE s.course_id=?",
-                (course_id,),
-            )
-            late_minutes = cur.fetchone()[0] or 0
-            fehlstunden = (absent_minutes or 0) / float(LESSON_MINUTES)
-            leader = (r["leader_short"] or "") + (
-                (" (" + r["leader_name"] + ")") if r["leader_name"] else ""
-            )
+            fehlstunden = (r["absent_minutes"] or 0) / float(LESSON_MINUTES)
             data.append({
-                "id": course_id,
+                "id": r["id"],
                 "name": r["name"],
-                "leader": leader,
+                "leader": r["leader"],
                 "leader_id": r["leader_id"],
                 "leader_short": r["leader_short"],
                 "leader_name": r["leader_name"],
                 "student_count": r["student_count"],
-                "avg_grade": avg_grade,
+                "avg_grade": r["avg_grade"] or None,
                 "fehlstunden": fehlstunden,
-                "verspaetung_min": late_minutes,
+                "verspaetung_min": r["late_minutes"] or 0,
             })
-        conn.close()
-
-        key_map = {
-            "name": lambda x: (x["name"] or "").lower(),
-            "size": lambda x: x["student_count"],
-            "avg":  lambda x: (x["avg_grade"] if x["avg_grade"] is not None else 9999.0),
-            "fehl": lambda x: x["fehlstunden"],
-            "late": lambda x: x["verspaetung_min"],
-            "id":   lambda x: x["id"],
-            "leader": lambda x: (x["leader"] or "").lower(),
-        }
-        keyfunc = key_map.get(sort, key_map["name"])
-        reverse = True if direction == "desc" else False
-        data.sort(key=keyfunc, reverse=reverse)
-
-        def get_sort_link(col):
-            next_dir = "desc" if (sort == col and direction == "asc") else "asc"
-            return f"/courses?sort={col}&dir={next_dir}"
-
-        sort_links = {
-            "id": get_sort_link("id"),
-            "name": get_sort_link("name"),
-            "size": get_sort_link("size"),
-            "avg": get_sort_link("avg"),
-            "fehl": get_sort_link("fehl"),
-            "late": get_sort_link("late"),
-            "leader": get_sort_link("leader"),
-        }
-
-        conn = get_db_connection(); cur = conn.cursor()
         teachers = get_all_teachers(cur)
         conn.close()
 
+        sort_links = _sort_links(_COURSE_SORT_LINKS, sort, direction)
+
         context = {
             "data": data,
             "teachers": teachers,
@@ -1194,42 +1818,64 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         if course_id and course_id.isdigit():
             where.append("s.course_id=?"); plist.append(int(course_id))
         if search_query:
-            where.append("(s.first_name LIKE ? OR s.last_name LIKE ?)")
-            plist.extend([f"%{search_query}%", f"%{search_query}%"])
+            # % und _ sind in LIKE Platzhalter, im Trigramm-Index aber normale Zeichen:
+            # solche Suchen bleiben bei LIKE, damit sich ihr Ergebnis nicht ändert
+            if (len(search_query) >= 3 and "%" not in search_query and "_" not in search_query
+                    and _students_fts_ready(cur)):
+                # Trigramm-Index: Phrase = Teilstring in Vor- oder Nachname (wie LIKE '%q%')
+                where.append("s.id IN (SELECT rowid FROM students_fts WHERE students_fts MATCH ?)")
+                plist.append('"' + search_query.replace('"', '""') + '"')
+            else:
+                where.append("(s.first_name LIKE ? OR s.last_name LIKE ?)")
+                plist.extend([f"%{search_query}%", f"%{search_query}%"])
+
+        # Optionales Blättern: ?limit=N[&after=<Schüler-ID>]. Keyset statt OFFSET: die
+        # Folgeseite setzt hinter (Sortierwert, id) der letzten Zeile an, ohne die
+        # vorherigen Zeilen erneut zu lesen. Ohne limit wird wie bisher alles geliefert.
+        limit = _parse_positive_int(params.get("limit", [""])[0])
+        after = _parse_positive_int(params.get("after", [""])[0])
+        sort_expr = STUDENT_SORT_COLUMNS.get(sort)
+        if not sort_expr:
+            # Standardsortierung (Klasse, Name) hat keinen Keyset-Anker: ohne Weiter-Link
+            # wären Zeilen hinter der ersten Seite unerreichbar, also ganze Liste
+            limit = after = None
+        if limit and after:
+            anchor = cur.execute(
+                f"SELECT {sort_expr} FROM students s JOIN classes c ON s.class_id=c.id "
+                "LEFT JOIN courses d ON s.course_id=d.id WHERE s.id=?", (after,)
+            ).fetchone()
+            if anchor:
+                cond, cond_params = _keyset_after(sort_expr, direction == "desc", anchor[0], after, "s.id")
+                where.append(cond); plist.extend(cond_params)
         if where: base += "WHERE " + " AND ".join(where) + " "
 
-        order_sql = {
-            "first": "ORDER BY s.first_name",
-            "last":  "ORDER BY s.last_name",
-            "class": "ORDER BY c.name",
-            "course":"ORDER BY d.name",
-            "id":    "ORDER BY s.id",
-        }.get(sort, "ORDER BY c.name, s.last_name, s.first_name")
+        order_sql = f"ORDER BY {sort_expr}" if sort_expr else "ORDER BY c.name, s.last_name, s.first_name"
         order_sql += " DESC" if direction == "desc" else " ASC"
+        order_sql += ", s.id"  # eindeutige Reihenfolge bei Gleichstand, unabhängig vom Query-Plan
+        if limit:
+            order_sql += " LIMIT ?"; plist.append(limit)
 
-        rows = cur.execute(base + order_sql, plist).fetchall()
-
-        total_classes = cur.execute("SELECT COUNT(*) FROM classes").fetchone()[0]
-        total_courses = cur.execute("SELECT COUNT(*) FROM courses").fetchone()[0]
-        total_students = cur.execute("SELECT COUNT(*) FROM students").fetchone()[0]
+        total_classes, total_courses, total_students = cur.execute(
+            "SELECT (SELECT COUNT(*) FROM classes), (SELECT COUNT(*) FROM courses), (SELECT COUNT(*) FROM students)"
+        ).fetchone()
 
-        conn.close()
+        # Ganze Liste: Zeilen direkt beim Rendern lesen. Eine Seite (limit) ist klein und
+        # wird für den Weiter-Link (letzte ID) ohnehin komplett gebraucht.
+        rows = conn.execute(base + order_sql, plist)
+        if limit:
+            rows = rows.fetchall()
+
+        next_url = None
+        if limit and len(rows) == limit:
+            next_url = "/students?" + urllib.parse.urlencode(
+                [(k, v) for k, v in (("class_id", class_id), ("course_id", course_id), ("q", search_query)) if v]
+                + [("sort", sort), ("dir", direction), ("limit", limit), ("after", rows[-1]["id"])]
+            )
 
-        def get_sort_link(col):
-            next_dir = "desc" if (sort == col and direction == "asc") else "asc"
-            qs = []
-            if class_id: qs.append(f"class_id={class_id}")
-            if course_id: qs.append(f"course_id={course_id}")
-            qs.append(f"sort={col}&dir={next_dir}")
-            return f"/students?{'&'.join(qs)}"
-
-        sort_links = {
-            "id": get_sort_link("id"),
-            "first": get_sort_link("first"),
-            "last": get_sort_link("last"),
-            "class": get_sort_link("class"),
-            "course": get_sort_link("course"),
-        }
+        pre = (f"class_id={class_id}&" if class_id else "") + (f"course_id={course_id}&" if course_id else "")
+        post = f"&limit={limit}" if limit else ""
+        sort_links = {col: url.format(pre=pre, post=post)
+                      for col, url in _sort_links(_STUDENT_SORT_LINKS, sort, direction).items()}
 
         context = {
             "total_classes": total_classes,
@@ -1242,8 +1888,9 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "course_id": course_id,
             "sort_links": sort_links,
             "search_query": search_query,
+            "next_url": next_url,
         }
-        self.render("students.html", context)
+        self._render_rows(conn, "students.html", context, rows)
 
     # ======= Klassen-Detail =======
     def _handle_class_detail(self, params):
@@ -1251,28 +1898,25 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         if not class_id:
             self._send_html("<html><body><h1>Fehler</h1><p>Keine Klassen-ID angegeben.</p><p><a href='/classes'>Zurück</a></p></body></html>"); return
         conn = get_db_connection(); cur = conn.cursor()
-        cur.execute("SELECT id,name FROM classes WHERE id=?", (class_id,))
+        cur.execute("SELECT id,name,teacher_id FROM classes WHERE id=?", (class_id,))
         row = cur.fetchone()
         if not row:
             conn.close(); self._send_html("<html><body><h1>Fehler</h1><p>Klasse nicht gefunden.</p><p><a href='/classes'>Zurück</a></p></body></html>"); return
         cname = row["name"]
-        total_students = cur.execute("SELECT COUNT(*) FROM students WHERE class_id=?", (class_id,)).fetchone()[0]
-        course_count_class = cur.execute("SELECT COUNT(DISTINCT course_id) FROM students WHERE class_id=? AND course_id IS NOT NULL", (class_id,)).fetchone()[0]
-        rows = cur.execute(
+        # COUNT(DISTINCT ...) lässt NULL-Kurse ohnehin weg
+        total_students, course_count_class = cur.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT course_id) FROM students WHERE class_id=?", (class_id,)
+        ).fetchone()
+        classes = get_all_classes(cur)
+        courses = get_all_courses(cur)
+        teachers_for_select = get_all_teachers(cur)
+        rows = conn.execute(
             "SELECT s.id, s.first_name, s.last_name, c.name AS class_name, d.name AS course_name, s.course_id, s.class_id "
             "FROM students s JOIN classes c ON s.class_id=c.id "
             "LEFT JOIN courses d ON s.course_id=d.id WHERE c.id=? ORDER BY s.last_name, s.first_name",
             (class_id,)
-        ).fetchall()
-        classes = get_all_classes(cur)
-        courses = get_all_courses(cur)
-        conn.close()
-
-        conn2 = get_db_connection(); cur2 = conn2.cursor()
-        row_teacher = cur2.execute("SELECT teacher_id FROM classes WHERE id=?", (class_id,)).fetchone()
-        teachers_for_select = get_all_teachers(cur2)
-        conn2.close()
-        current_teacher_id = row_teacher['teacher_id'] if row_teacher else None
+        )
+        current_teacher_id = row['teacher_id']
 
         context = {
             "class_id": class_id,
@@ -1285,7 +1929,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "current_teacher_id": current_teacher_id,
             "teachers_for_select": teachers_for_select,
         }
-        self.render("class_detail.html", context)
+        self._render_rows(conn, "class_detail.html", context, rows)
 
     # ======= Kurs-Detail =======
     def _handle_course_detail(self, params):
@@ -1294,11 +1938,9 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             self._send_html("<html><body><h1>Fehler</h1><p>Keine Kurs-ID angegeben.</p><p><a href='/courses'>Zurück</a></p></body></html>"); return
         conn = get_db_connection(); cur = conn.cursor()
         cur.execute(
-            "SELECT d.id, d.name AS course_name, c.name AS class_name, d.leader_id, "
-            "t.short AS leader_short, t.name AS leader_name "
+            "SELECT d.id, d.name AS course_name, c.name AS class_name, d.leader_id "
             "FROM courses d "
             "LEFT JOIN classes c ON d.class_id=c.id "
-            "LEFT JOIN teachers t ON d.leader_id=t.id "
             "WHERE d.id=?",
             (course_id,)
         )
@@ -1307,18 +1949,16 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             conn.close(); self._send_html("<html><body><h1>Fehler</h1><p>Kurs nicht gefunden.</p><p><a href='/courses'>Zurück</a></p></body></html>"); return
         course_name = row["course_name"]
         class_name = row["class_name"] or ""
-        leader = (row["leader_short"] or "") + ((" (" + row["leader_name"] + ")") if row["leader_name"] else "")
         total_students_in_course = cur.execute("SELECT COUNT(*) FROM students WHERE course_id=?", (course_id,)).fetchone()[0]
-        rows = cur.execute(
+        classes = get_all_classes(cur)
+        courses = get_all_courses(cur)
+        teachers = get_all_teachers(cur)
+        rows = conn.execute(
             "SELECT s.id, s.first_name, s.last_name, c.name AS class_name, s.class_id, s.course_id "
             "FROM students s JOIN classes c ON s.class_id=c.id "
             "WHERE s.course_id=? ORDER BY s.last_name, s.first_name",
             (course_id,),
-        ).fetchall()
-        classes = get_all_classes(cur)
-        courses = get_all_courses(cur)
-        teachers = get_all_teachers(cur)
-        conn.close()
+        )
 
         context = {
             "course_id": course_id,
@@ -1331,7 +1971,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "courses": courses,
             "teachers": teachers,
         }
-        self.render("course_detail.html", context)
+        self._render_rows(conn, "course_detail.html", context, rows)
 
     def _handle_student_detail(self, params):
         student_id = params.get("id", [None])[0]
@@ -1350,36 +1990,42 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         if not srow:
             conn.close(); self._send_html("<html><body><h1>Fehler</h1><p>Sch&uuml;ler nicht gefunden.</p><p><a href='/students'>Zurück</a></p></body></html>"); return
 
-        total_attendance = cur.execute("SELECT COUNT(*) FROM attendance_records WHERE student_id=?", (student_id,)).fetchone()[0]
-        total_present    = cur.execute("SELECT COUNT(*) FROM attendance_records WHERE student_id=? AND status='present'", (student_id,)).fetchone()[0]
-        total_absent     = cur.execute("SELECT COUNT(*) FROM attendance_records WHERE student_id=? AND status='absent'", (student_id,)).fetchone()[0]
-        total_absent_minutes = cur.execute("SELECT COALESCE(SUM(absent_minutes),0) FROM attendance_records WHERE student_id=? AND status='absent'", (student_id,)).fetchone()[0]
-        total_late_minutes = cur.execute("SELECT COALESCE(SUM(late_minutes),0) FROM attendance_records WHERE student_id=?", (student_id,)).fetchone()[0]
-
-        total_grades = cur.execute("SELECT COUNT(*) FROM grade_records WHERE student_id=?", (student_id,)).fetchone()[0]
-        perf_count, perf_avg = cur.execute("SELECT COUNT(*), COALESCE(AVG(grade),0) FROM grade_records WHERE student_id=? AND type='performance'", (student_id,)).fetchone()
-        spont_count, spont_avg = cur.execute("SELECT COUNT(*), COALESCE(AVG(grade),0) FROM grade_records WHERE student_id=? AND type='spontaneous'", (student_id,)).fetchone()
+        # Kennzahlen per bedingter Aggregation: eine Abfrage je Tabelle
+        (total_attendance, total_present, total_absent,
+         total_absent_minutes, total_late_minutes) = cur.execute(
+            "SELECT COUNT(*), COALESCE(SUM(status='present'),0), COALESCE(SUM(status='absent'),0), "
+            "COALESCE(SUM(CASE WHEN status='absent' THEN absent_minutes END),0), COALESCE(SUM(late_minutes),0) "
+            "FROM attendance_records WHERE student_id=?", (student_id,)
+        ).fetchone()
+        total_grades, perf_count, perf_avg, spont_count, spont_avg = cur.execute(
+            "SELECT COUNT(*), "
+            "COALESCE(SUM(type='performance'),0), COALESCE(AVG(CASE WHEN type='performance' THEN grade END),0), "
+            "COALESCE(SUM(type='spontaneous'),0), COALESCE(AVG(CASE WHEN type='spontaneous' THEN grade END),0) "
+            "FROM grade_records WHERE student_id=?", (student_id,)
+        ).fetchone()
         perf_avg_display = f"{perf_avg:.2f}" if perf_count else "-"
         spont_avg_display = f"{spont_avg:.2f}" if spont_count else "-"
 
         classes = get_all_classes(cur)
         courses = get_all_courses(cur)
 
-        recs = []
+        # Anwesenheit und Noten als ein Verlauf; gemischt und sortiert wird in SQL
+        branches = []
+        plist = []
         if filter_type in ("", "attendance", "present", "absent"):
             q = "SELECT date, period, 'attendance' AS kind, status, absent_minutes, late_minutes, NULL AS type, NULL AS grade, NULL AS subject, NULL as comment FROM attendance_records WHERE student_id=?"
-            plist = [student_id]
             if filter_type == "present": q += " AND status='present'"
             if filter_type == "absent":  q += " AND status='absent'"
-            recs.extend(cur.execute(q, plist).fetchall())
+            branches.append(q); plist.append(student_id)
         if filter_type in ("", "grades", "performance", "spontaneous"):
             q = "SELECT date, period, 'grade' AS kind, NULL AS status, NULL AS absent_minutes, NULL AS late_minutes, type, grade, subject, comment FROM grade_records WHERE student_id=?"
-            plist = [student_id]
             if filter_type == "performance": q += " AND type='performance'"
             if filter_type == "spontaneous": q += " AND type='spontaneous'"
-            recs.extend(cur.execute(q, plist).fetchall())
-        recs.sort(key=lambda r: r["date"], reverse=True)
-        conn.close()
+            branches.append(q); plist.append(student_id)
+        recs = []
+        if branches:
+            # Gleiches Datum: Anwesenheit vor Noten, dann nach Stunde
+            recs = conn.execute(" UNION ALL ".join(branches) + " ORDER BY date DESC, kind, period", plist)
 
         fehlstunden = (total_absent_minutes or 0) / float(LESSON_MINUTES)
         today_str = datetime.date.today().isoformat()
@@ -1405,7 +2051,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "filter_type": filter_type,
             "today_str": today_str,
         }
-        self.render("student_detail.html", context)
+        self._render_rows(conn, "student_detail.html", context, recs)
 
     # ---------- Admin-Bereich ----------
     def _handle_admin(self, params):
@@ -1430,20 +2076,22 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("INSERT OR IGNORE INTO subjects(name, short) VALUES(?, ?)", (name, short))
+            self._log_change('subjects', None, 'create', '', f'{name}/{short}', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('subjects', None, 'create', '', f'{name}/{short}', 'manual', None)
+        _bump_ref_version()
         self._redirect('/admin/subjects')
 
     def _post_admin_subject_delete(self):
         data = self._parse_post()
-        sid = int(data.get('id','0') or '0')
+        sid = _parse_int(data, 'id')
         if sid<=0:
-            return self._send_html("<h1>400</h1><p>Ungültige ID.</p>", status=400)
+            return self._send_html(_INVALID_ID_HTML, status=400)
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("DELETE FROM subjects WHERE id=?", (sid,))
+            self._log_change('subjects', sid, 'delete', '', '', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('subjects', sid, 'delete', '', '', 'manual', None)
+        _invalidate_caches()
         self._redirect('/admin/subjects')
 
     # ----- Teachers Admin -----
@@ -1480,40 +2128,40 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("INSERT OR IGNORE INTO teachers(short, name) VALUES(?, ?)", (short, name))
+            self._log_change('teachers', None, 'create', '', f'{short}/{name}', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('teachers', None, 'create', '', f'{short}/{name}', 'manual', None)
+        _bump_ref_version()
         self._redirect('/admin/teachers')
 
     def _post_admin_teacher_delete(self):
         data = self._parse_post()
-        tid = int(data.get('id','0') or '0')
+        tid = _parse_int(data, 'id')
         if tid<=0:
-            return self._send_html("<h1>400</h1><p>Ungültige ID.</p>", status=400)
+            return self._send_html(_INVALID_ID_HTML, status=400)
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("DELETE FROM teachers WHERE id=?", (tid,))
+            self._log_change('teachers', tid, 'delete', '', '', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('teachers', tid, 'delete', '', '', 'manual', None)
+        _bump_ref_version()
         self._redirect('/admin/teachers')
 
     # ----- Courses Admin -----
     def _handle_admin_courses(self, params):
         conn = get_db_connection(); cur = conn.cursor()
-        courses_rows = cur.execute(
-            "SELECT d.id, d.name, d.leader_id, t.short AS leader_short, t.name AS leader_name, "
-            "(SELECT COUNT(*) FROM students s WHERE s.course_id = d.id) AS student_count "
-            "FROM courses d LEFT JOIN teachers t ON d.leader_id = t.id ORDER BY d.name"
-        ).fetchall()
-
-        courses_data = []
-        for course in courses_rows:
-            course_dict = dict(course)
-            class_list_rows = cur.execute(
-                "SELECT DISTINCT c.name FROM classes c JOIN students s ON c.id = s.class_id WHERE s.course_id = ? ORDER BY c.name",
-                (course['id'],)
-            ).fetchall()
-            course_dict['classes_in_course'] = ", ".join([r['name'] for r in class_list_rows])
-            courses_data.append(course_dict)
+        # Klassen je Kurs packt SQLite als JSON-Array mit in die Kurszeile. Die Reihenfolge
+        # von json_group_array ist nicht festgelegt, daher wird in Python sortiert (wie
+        # ORDER BY classes.name, BINARY)
+        courses_data = [
+            dict(course, classes_in_course=", ".join(sorted(json.loads(course["class_json"]))))
+            for course in cur.execute(
+                "SELECT d.id, d.name, d.leader_id, t.short AS leader_short, t.name AS leader_name, "
+                "(SELECT COUNT(*) FROM students s WHERE s.course_id = d.id) AS student_count, "
+                "(SELECT json_group_array(DISTINCT c.name) FROM students s JOIN classes c ON c.id = s.class_id "
+                " WHERE s.course_id = d.id) AS class_json "
+                "FROM courses d LEFT JOIN teachers t ON d.leader_id = t.id ORDER BY d.name"
+            )
+        ]
 
         teachers = get_all_teachers(cur)
         conn.close()
@@ -1548,7 +2196,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "courses": courses,
             "subjects": subjects,
             "days": ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag'],
-            "periods": [item['period'] for item in SCHEDULE_PATTERN if 'period' in item]
+            "periods": list(_schedule_periods())
         }
         self.render("admin_timetable.html", context)
 
@@ -1576,23 +2224,19 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "courses": courses,
             "subjects": subjects,
             "days": ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag'],
-            "periods": [item['period'] for item in SCHEDULE_PATTERN if 'period' in item]
+            "periods": list(_schedule_periods())
         }
         self.render("admin_timetable_edit.html", context)
 
     def _check_timetable_conflict(self, cur, day, period, class_id, course_id, exclude_id=None):
         """Checks for a conflict in the timetable. Returns True if a conflict exists."""
+        # Nur noch Rückfall für Bestands-DBs ohne ux_tt_class/ux_tt_course (siehe Migration);
+        # wie dort zählen nur Wochenplan-Zeilen (date IS NULL), keine datierten Ausfälle/Vertretungen.
         # A conflict exists if a class is double-booked, or a course is double-booked.
         if not class_id and not course_id:
             return False
 
-        query_parts = []
         params = [day, period]
-
-        # Build query for class or course. A slot can be for a class OR a course.
-        # If a class is given, check for conflicts for that class.
-        # If a course is given, check for conflicts for that course.
-        # If both are given (e.g. a course within a class), check both.
         conflict_clauses = []
         if class_id:
             conflict_clauses.append("class_id = ?")
@@ -1601,7 +2245,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             conflict_clauses.append("course_id = ?")
             params.append(course_id)
 
-        base_query = f"SELECT id FROM timetable WHERE day = ? AND period = ? AND ({' OR '.join(conflict_clauses)})"
+        base_query = f"SELECT id FROM timetable WHERE day = ? AND period = ? AND date IS NULL AND ({' OR '.join(conflict_clauses)})"
 
         if exclude_id:
             base_query += " AND id != ?"
@@ -1624,18 +2268,21 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
              return self._send_html("<h1>400</h1><p>Missing required fields: Day, Period, Subject and Class/Course.</p>", status=400)
 
         conn = get_db_connection(); cur = conn.cursor()
-
-        if self._check_timetable_conflict(cur, day, period, class_id, course_id):
-            conn.close()
-            return self._send_html("<h1>409 Conflict</h1><p>A lesson for this class/course already exists at this time.</p><p><a href='/admin/timetable'>Back</a></p>", status=409)
-
-        with conn:
-            cur.execute(
-                """INSERT INTO timetable (day, period, subject_id, class_id, course_id, room, is_double, slot, date)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)""",
-                (day, period, subject_id, class_id, course_id, room, 1 if is_double else 0, period)
-            )
+        # Doppelbelegung erkennt die DB selbst (ux_tt_class/ux_tt_course): kein RETURNING-Treffer = Konflikt.
+        # Fehlen die Indizes (Altdaten mit Doppelbelegung), wird wie früher vorab geprüft.
+        with conn.write_tx():
+            if not _timetable_unique_ready(cur) and self._check_timetable_conflict(cur, day, period, class_id, course_id):
+                created = None
+            else:
+                created = cur.execute(
+                    """INSERT INTO timetable (day, period, subject_id, class_id, course_id, room, is_double, slot, date)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)
+                       ON CONFLICT DO NOTHING RETURNING id""",
+                    (day, period, subject_id, class_id, course_id, room, int(is_double), period)
+                ).fetchone()
         conn.close()
+        if created is None:
+            return self._send_html(_TIMETABLE_CONFLICT_HTML, status=409)
         self._redirect('/admin/timetable')
 
     def _post_admin_timetable_update(self):
@@ -1653,19 +2300,23 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
              return self._send_html("<h1>400</h1><p>Missing required fields.</p>", status=400)
 
         conn = get_db_connection(); cur = conn.cursor()
-
-        if self._check_timetable_conflict(cur, day, period, class_id, course_id, exclude_id=entry_id):
+        # Der eigene Eintrag kollidiert nicht mit sich selbst; jede andere Belegung verletzt den Index
+        # (ohne Indizes: Vorabprüfung wie beim Anlegen)
+        try:
+            with conn.write_tx():
+                if not _timetable_unique_ready(cur) and self._check_timetable_conflict(
+                        cur, day, period, class_id, course_id, exclude_id=entry_id):
+                    raise sqlite3.IntegrityError("timetable conflict")
+                cur.execute(
+                    """UPDATE timetable
+                       SET day=?, period=?, subject_id=?, class_id=?, course_id=?, room=?, is_double=?, slot=?
+                       WHERE id=?""",
+                    (day, period, subject_id, class_id, course_id, room, int(is_double), period, entry_id)
+                )
+        except sqlite3.IntegrityError:
+            return self._send_html(_TIMETABLE_CONFLICT_HTML, status=409)
+        finally:
             conn.close()
-            return self._send_html("<h1>409 Conflict</h1><p>A lesson for this class/course already exists at this time.</p><p><a href='/admin/timetable'>Back</a></p>", status=409)
-
-        with conn:
-            cur.execute(
-                """UPDATE timetable
-                   SET day=?, period=?, subject_id=?, class_id=?, course_id=?, room=?, is_double=?, slot=?
-                   WHERE id=?""",
-                (day, period, subject_id, class_id, course_id, room, 1 if is_double else 0, period, entry_id)
-            )
-        conn.close()
         self._redirect('/admin/timetable')
 
     def _post_admin_course_create(self):
@@ -1673,8 +2324,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         course_name = (data.get('course_name') or '').strip()
         if not course_name:
             return self._send_html("<h1>400</h1><p>Kursname erforderlich.</p>", status=400)
-        leader_id_raw = data.get('leader_id', '0') or '0'
-        leader_id = int(leader_id_raw) if leader_id_raw.isdigit() else 0
+        leader_id = _parse_int(data, 'leader_id')
         new_teacher_short = (data.get('new_teacher_short') or '').strip()
         new_teacher_name = (data.get('new_teacher_name') or '').strip()
         conn = get_db_connection(); cur = conn.cursor()
@@ -1682,29 +2332,28 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             if new_teacher_short or new_teacher_name:
                 leader_id = create_teacher(cur, new_teacher_short, new_teacher_name)
             norm_name = _normalize_group_name(course_name)
-            row = cur.execute("SELECT id FROM courses WHERE LOWER(name)=LOWER(?)", (norm_name,)).fetchone()
+            row = cur.execute("SELECT id FROM courses WHERE name=? COLLATE NOCASE", (norm_name,)).fetchone()
             if row:
                 if leader_id > 0:
-                    cur.execute("UPDATE courses SET leader_id=? WHERE id=?", (leader_id, row['id']))
+                    cur.execute(_SET_COURSE_LEADER_SQL, (leader_id, row['id']))
             else:
                 cur.execute("INSERT INTO courses(name, leader_id) VALUES(?, ?)", (norm_name, leader_id if leader_id>0 else None))
+            self._log_change('courses', None, 'create', '', course_name, 'manual', None, cur=cur)
         conn.close()
-        self._log_change('courses', None, 'create', '', course_name, 'manual', None)
+        _bump_ref_version()
         self._redirect('/admin/courses')
 
     def _post_admin_course_delete(self):
         data = self._parse_post()
-        try:
-            cid = int(data.get('id','0') or '0')
-        except ValueError:
-            cid = 0
+        cid = _parse_int(data, 'id')
         if cid <= 0:
-            return self._send_html("<h1>400</h1><p>Ungültige ID.</p>", status=400)
+            return self._send_html(_INVALID_ID_HTML, status=400)
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("DELETE FROM courses WHERE id=?", (cid,))
+            self._log_change('courses', cid, 'delete', '', '', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('courses', cid, 'delete', '', '', 'manual', None)
+        _invalidate_caches()
         self._redirect('/admin/courses')
 
     # ---------- Export/Import Leistungsabfragen ----------
@@ -1735,24 +2384,13 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         type_ = (data.get('type') or '').strip()
         description = (data.get('description') or '').strip()
         date = (data.get('date') or '').strip()
-        subject_id_raw = data.get('subject_id', '0') or '0'
-        class_id_raw = data.get('class_id', '0') or '0'
-        course_id_raw = data.get('course_id', '0') or '0'
-        try: subject_id = int(subject_id_raw)
-        except ValueError: subject_id = 0
-        try: class_id = int(class_id_raw)
-        except ValueError: class_id = 0
-        try: course_id = int(course_id_raw)
-        except ValueError: course_id = 0
+        subject_id = _parse_int(data, 'subject_id')
+        class_id = _parse_int(data, 'class_id')
+        course_id = _parse_int(data, 'course_id')
         max_op_points_raw = data.get('max_op_points', '0') or '0'
         try: max_op_points = float(max_op_points_raw)
         except ValueError: max_op_points = 0.0
-        task_count_raw = data.get('task_count', '0') or '0'
-        try:
-            task_count = int(task_count_raw);
-            if task_count < 0: task_count = 0
-        except ValueError:
-            task_count = 0
+        task_count = _parse_int(data, 'task_count')
         max_points_str = (data.get('max_points') or '').strip()
         max_points_list = []
         if max_points_str:
@@ -1780,11 +2418,11 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
                     (perf_id, i, maxp)
                 )
 
-        # Log create
-        group_txt = ""
-        if class_id>0: group_txt = f"Klasse {class_id}"
-        elif course_id>0: group_txt = f"Kurs {course_id}"
-        self._log_change('performance_queries', perf_id, 'create', '', '', 'manual', f"{type_} {description}".strip() or None)
+            # Log create
+            group_txt = ""
+            if class_id>0: group_txt = f"Klasse {class_id}"
+            elif course_id>0: group_txt = f"Kurs {course_id}"
+            self._log_change('performance_queries', perf_id, 'create', '', '', 'manual', f"{type_} {description}".strip() or None, cur=cur)
 
         # CSV Vorlage
         cur2 = conn.cursor()
@@ -1794,24 +2432,23 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             stu_rows = cur2.execute("SELECT id, last_name, first_name FROM students WHERE course_id=? ORDER BY last_name, first_name", (course_id,)).fetchall()
         else:
             stu_rows = []
-        header = ["StudentID","Nachname","Vorname"]
-        for i in range(1, task_count+1):
-            header.append(f"Aufgabe{i}")
-        header.extend(["OP","ZP"])
-        lines = [";".join(header)]
-        for s in stu_rows:
-            row = [str(s['id']), s['last_name'], s['first_name']]
-            row.extend(['' for _ in range(task_count)])
-            row.extend(['',''])
-            lines.append(";".join(row))
-        csv_content = "\n".join(lines)
         conn.close()
-        filename = f"leistungsabfrage_{perf_id}.csv"
+        self._send_performance_csv(perf_id, task_count, stu_rows)
+
+    def _send_performance_csv(self, perf_id, task_count, stu_rows):
+        """CSV-Vorlage einer Leistungsabfrage: je Schüler eine Zeile, Aufgaben/OP/ZP leer."""
+        header = ["StudentID", "Nachname", "Vorname"] + [f"Aufgabe{i}" for i in range(1, task_count+1)] + ["OP", "ZP"]
+        empty_suffix = ";" * (task_count + 2)  # leere Aufgabenspalten + OP + ZP
+        # Zeilen einzeln kodiert in den gepufferten Ausgabestrom, ohne Gesamt-String;
+        # die Länge ergibt sich aus der Summe der Zeilen
+        chunks = [";".join(header).encode('utf-8')]
+        chunks.extend(f"\n{s['id']};{s['last_name']};{s['first_name']}{empty_suffix}".encode('utf-8') for s in stu_rows)
         self.send_response(200)
         self.send_header("Content-Type", "text/csv; charset=utf-8")
-        self.send_header("Content-Disposition", f"attachment; filename={filename}")
+        self.send_header("Content-Disposition", f"attachment; filename=leistungsabfrage_{perf_id}.csv")
+        self.send_header("Content-Length", str(sum(map(len, chunks))))
         self.end_headers()
-        self.wfile.write(csv_content.encode('utf-8'))
+        self.wfile.writelines(chunks)
 
     def _post_performance_import(self):
         data = self._parse_post()
@@ -1823,24 +2460,18 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             return self._send_html("<h1>400</h1><p>Ungültige Abfrage-ID.</p>", status=400)
         if not csv_data.strip():
             return self._send_html("<h1>400</h1><p>Keine CSV-Daten übermittelt.</p>", status=400)
-        lines = [l.strip() for l in csv_data.strip().splitlines() if l.strip()]
-        if not lines:
+        # QUOTE_NONE: wie bisher nur am ';' trennen. Zellen werden nicht gestrippt,
+        # int()/float() ignorieren Leerraum ohnehin; leere Zeilen fallen unten raus.
+        reader = csv.reader(io.StringIO(csv_data), delimiter=';', quoting=csv.QUOTE_NONE)
+        header = next((r for r in reader if any(h.strip() for h in r)), None)
+        if header is None:
             return self._send_html("<h1>400</h1><p>CSV-Daten konnten nicht gelesen werden.</p>", status=400)
+        task_count = sum(1 for h in header if h.strip().startswith('Aufgabe'))
 
-        header = [h.strip() for h in lines[0].split(';')]
-        try:
-            task_numbers = [h for h in header if h.startswith('Aufgabe')]
-            task_count = len(task_numbers)
-        except Exception:
-            task_count = 0
-
-        conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            cur.execute("DELETE FROM performance_task_results WHERE performance_id=?", (perf_id,))
-            cur.execute("DELETE FROM performance_results WHERE performance_id=?", (perf_id,))
-        imported_rows = 0
-        for line in lines[1:]:
-            parts = [p.strip() for p in line.split(';')]
+        # Erst die ganze CSV einlesen, dann alles in einer Transaktion ersetzen
+        result_rows = []
+        task_rows = []
+        for parts in reader:
             if len(parts) < 3:
                 continue
             try:
@@ -1857,26 +2488,18 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
                 zp_str = parts[3+task_count+1]
                 try: zp = float(zp_str) if zp_str else 0.0
                 except ValueError: zp = 0.0
-            with conn:
-                cur.execute(
-                    "INSERT INTO performance_results(performance_id, student_id, op_points, zp_points) VALUES(?,?,?,?)",
-                    (perf_id, student_id, op, zp)
-                )
-                for i, val in enumerate(values, start=1):
-                    try:
-                        pts = float(val) if val else 0.0
-                    except ValueError:
-                        pts = 0.0
-                    cur.execute(
-                        "INSERT INTO performance_task_results(performance_id, student_id, task_number, points) VALUES(?,?,?,?)",
-                        (perf_id, student_id, i, pts)
-                    )
-            imported_rows += 1
-        conn.close()
+            result_rows.append((perf_id, student_id, op, zp))
+            for i, val in enumerate(values, start=1):
+                try:
+                    pts = float(val) if val else 0.0
+                except ValueError:
+                    pts = 0.0
+                task_rows.append((perf_id, student_id, i, pts))
+        imported_rows = len(result_rows)
 
-        # Log Import
-        connm = get_db_connection(); curm = connm.cursor()
-        meta = curm.execute(
+        conn = get_db_connection(); cur = conn.cursor()
+        # Log-Kommentar vorab, der Log-Eintrag läuft dann in der Import-Transaktion mit
+        meta = cur.execute(
             "SELECT p.type, p.description, c.name AS class_name, d.name AS course_name, s.short AS subj_short, s.name AS subj_name "
             "FROM performance_queries p "
             "LEFT JOIN classes c ON p.class_id=c.id "
@@ -1884,11 +2507,23 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             "LEFT JOIN subjects s ON p.subject_id=s.id "
             "WHERE p.id=?", (perf_id,)
         ).fetchone()
-        connm.close()
         group = (meta['class_name'] or meta['course_name'] or '') if meta else ''
         subj  = (meta['subj_short'] or meta['subj_name'] or '') if meta else ''
         comment = f"import; {meta['type'] if meta else ''} {group} {subj}".strip()
-        self._log_change('performance_results', perf_id, 'import', '', str(imported_rows), 'import', comment)
+
+        with conn:
+            cur.execute("DELETE FROM performance_task_results WHERE performance_id=?", (perf_id,))
+            cur.execute("DELETE FROM performance_results WHERE performance_id=?", (perf_id,))
+            cur.executemany(_INSERT_RESULT_SQL, result_rows)
+            if _has_unique_index(cur, "ux_perf_task_results"):
+                cur.executemany(_UPSERT_TASK_RESULT_SQL, task_rows)
+            else:
+                # Ohne eindeutigen Index selbst zusammenfassen (letzte Zeile gewinnt)
+                cur.executemany(_INSERT_TASK_RESULT_SQL, [
+                    (*key, points) for key, points in {row[:3]: row[3] for row in task_rows}.items()
+                ])
+            self._log_change('performance_results', perf_id, 'import', '', str(imported_rows), 'import', comment, cur=cur)
+        conn.close()
 
         self._redirect(f"/performance?id={perf_id}")
 
@@ -1917,79 +2552,68 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         tasks = cur.execute(
             "SELECT number, max_points FROM performance_tasks WHERE performance_id=? ORDER BY number",
             (pid,)
-    ).fetchall()
-        if not row:
-            conn.close()
-            return self._send_html("<h1>404</h1><p>Leistungsabfrage nicht gefunden.</p>", status=404)
-
-        tasks = cur.execute(
-            "SELECT number, max_points FROM performance_tasks WHERE performance_id=? ORDER BY number",
-            (pid,)
         ).fetchall()
         task_count = len(tasks)
+        # Teilnehmer: Klasse oder Kurs der Abfrage
         if row['class_id']:
-            students = cur.execute(
-                "SELECT id, last_name, first_name FROM students WHERE class_id=? ORDER BY last_name, first_name",
-                (row['class_id'],)
-            ).fetchall()
+            roster_col, roster_id = "class_id", row['class_id']
         elif row['course_id']:
-            students = cur.execute("SELECT id, last_name, first_name FROM students WHERE course_id=? ORDER BY last_name, first_name",
-                (row['course_id'],)
-            ).fetchall()
+            roster_col, roster_id = "course_id", row['course_id']
         else:
-            students = []
-
-        results = {}
-        for s in students:
-            results[s['id']] = {'op': 0.0, 'zp': 0.0, 'tasks': {}}
+            roster_col = roster_id = None
+        # Schüler samt ihrer Ergebniszeile in einer Abfrage (ohne Ergebnis: Defaults).
+        # Mehrere Zeilen je Schüler (Altbestand): die jüngste zählt.
+        students = []
+        if roster_col:
+            students = cur.execute(
+                "SELECT st.id, st.last_name, st.first_name, COALESCE(pr.op_points, 0.0), COALESCE(pr.zp_points, 0.0), "
+                "pr.grade_override, COALESCE(pr.comment, ''), COALESCE(pr.op_is_edited, 0), COALESCE(pr.zp_is_edited, 0) "
+                "FROM students st "
+                "LEFT JOIN performance_results pr ON pr.id = "
+                "  (SELECT MAX(id) FROM performance_results WHERE performance_id=? AND student_id=st.id) "
+                f"WHERE st.{roster_col}=? ORDER BY st.last_name, st.first_name",
+                (pid, roster_id)
+            ).fetchall()
+        results = {
+            sid: {'op': op or 0.0, 'zp': zp or 0.0, 'tasks': {}, 'override': override, 'comment': comment,
+                  'op_is_edited': op_is_edited, 'zp_is_edited': zp_is_edited}
+            for sid, _, _, op, zp, override, comment, op_is_edited, zp_is_edited in students
+        }
 
-        for r2 in cur.execute("SELECT student_id, op_points, zp_points, grade_override, comment, op_is_edited, zp_is_edited FROM performance_results WHERE performance_id=?", (pid,)).fetchall():
-            if r2['student_id'] in results:
-                results[r2['student_id']]['op'] = r2['op_points'] or 0.0
-                results[r2['student_id']]['zp'] = r2['zp_points'] or 0.0
-                results[r2['student_id']]['override'] = r2['grade_override']
-                results[r2['student_id']]['comment'] = r2['comment'] or ''
-                results[r2['student_id']]['op_is_edited'] = r2['op_is_edited']
-                results[r2['student_id']]['zp_is_edited'] = r2['zp_is_edited']
+        for sid, task_number, points in cur.execute(
+            "SELECT student_id, task_number, points FROM performance_task_results WHERE performance_id=?", (pid,)
+        ):
+            res = results.get(sid)
+            if res is not None:
+                res['tasks'][task_number] = points or 0.0
 
-        for r3 in cur.execute("SELECT student_id, task_number, points, is_edited FROM performance_task_results WHERE performance_id=?", (pid,)).fetchall():
-            if r3['student_id'] in results:
-                results[r3['student_id']]['tasks'][r3['task_number']] = r3['points'] or 0.0
+        # Aufgabenschnitte und Punktsummen rechnet SQLite (nur Teilnehmer der Klasse/des Kurses)
+        task_avg = {i: 0.0 for i in range(1, task_count+1)}
+        task_sums = {}
+        if students:
+            roster_filter = f"student_id IN (SELECT id FROM students WHERE {roster_col}=?)"
+            task_avg.update(cur.execute(
+                "SELECT task_number, AVG(points) FROM performance_task_results "
+                f"WHERE performance_id=? AND task_number BETWEEN 1 AND ? AND {roster_filter} GROUP BY task_number",
+                (pid, task_count, roster_id)
+            ))
+            task_sums = dict(cur.execute(
+                "SELECT student_id, SUM(points) FROM performance_task_results "
+                f"WHERE performance_id=? AND {roster_filter} GROUP BY student_id",
+                (pid, roster_id)
+            ))
 
         grade_scales = cur.execute("SELECT id, name FROM grade_scales ORDER BY id").fetchall()
         curr_scale_row = None
         if row['grade_scale_id']:
             curr_scale_row = cur.execute("SELECT id, name, definition FROM grade_scales WHERE id=?", (row['grade_scale_id'],)).fetchone()
 
-        scale_def = []
-        if curr_scale_row:
-            for ln in (curr_scale_row['definition'] or '').splitlines():
-                parts = [p.strip() for p in ln.split(';')]
-                if len(parts) == 3:
-                    grade = parts[0]
-                    try:
-                        minp = float(parts[1]); maxp = float(parts[2])
-                    except ValueError:
-                        continue
-                    scale_def.append((grade, minp, maxp))
+        scale_def = _parse_scale_def(curr_scale_row['definition'] or '') if curr_scale_row else ()
 
         total_max = sum([t['max_points'] for t in tasks]) if task_count > 0 else 0.0
-        student_totals = []
-        task_avg = {i:0.0 for i in range(1, task_count+1)}
-        if students:
-            for i in range(1, task_count+1):
-                total_i = 0.0; count_i = 0
-                for s in students:
-                    pts = results[s['id']]['tasks'].get(i)
-                    if pts is not None:
-                        total_i += pts
-                        count_i += 1
-                if count_i > 0:
-                    task_avg[i] = total_i / count_i
-            for s in students:
-                task_sum = sum([v for v in results[s['id']]['tasks'].values()])
-                tot = task_sum + results[s['id']]['op'] + results[s['id']]['zp']
-                student_totals.append(tot)
+        student_totals = [
+            task_sums.get(s['id'], 0) + results[s['id']]['op'] + results[s['id']]['zp'] for s in students
+        ]
 
         avg_points = sum(student_totals)/len(student_totals) if student_totals else 0.0
         best_points = max(student_totals) if student_totals else 0.0
@@ -2034,11 +2658,15 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         courses = get_all_courses(cur)
         base = (
             "SELECT p.id, p.date, p.type, p.description, p.class_id, p.course_id, "
-            "c.name AS class_name, d.name AS course_name, s.name AS subject_name, s.short AS subject_short, p.grade_scale_id "
+            "c.name AS class_name, d.name AS course_name, s.name AS subject_name, s.short AS subject_short, p.grade_scale_id, "
+            "ag.avg_grade "
             "FROM performance_queries p "
             "LEFT JOIN classes c ON p.class_id=c.id "
             "LEFT JOIN courses d ON p.course_id=d.id "
             "LEFT JOIN subjects s ON p.subject_id=s.id "
+            # Schnitt der Notenüberschreibungen je Abfrage, vorab gruppiert statt einer Abfrage pro Zeile
+            "LEFT JOIN (SELECT performance_id, AVG(grade_override) AS avg_grade FROM performance_results "
+            "  WHERE grade_override IS NOT NULL GROUP BY performance_id) ag ON ag.performance_id = p.id "
         )
         where = []
         plist = []
@@ -2057,22 +2685,8 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         rows = cur.execute(base, plist).fetchall()
         conn.close()
 
-        conn_for_avg = get_db_connection()
-        cur_for_avg = conn_for_avg.cursor()
-        augmented_rows = []
-        for row in rows:
-            row_dict = dict(row)
-            cur_for_avg.execute(
-                "SELECT AVG(grade_override) FROM performance_results WHERE performance_id = ? AND grade_override IS NOT NULL",
-                (row['id'],),
-            )
-            avg_grade = cur_for_avg.fetchone()[0]
-            row_dict['avg_grade'] = avg_grade
-            augmented_rows.append(row_dict)
-        conn_for_avg.close()
-
         context = {
-            "rows": augmented_rows,
+            "rows": rows,
             "classes": classes,
             "courses": courses,
             "class_id": class_id,
@@ -2087,7 +2701,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         try:
             pid = int(perf_id)
         except ValueError:
-            return self._send_html("<h1>400</h1><p>Ungültige ID.</p>", status=400)
+            return self._send_html(_INVALID_ID_HTML, status=400)
         conn = get_db_connection(); cur = conn.cursor()
         row = cur.execute("SELECT id, class_id, course_id FROM performance_queries WHERE id=?", (pid,)).fetchone()
         if not row:
@@ -2102,23 +2716,7 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         else:
             stu_rows = []
         conn.close()
-        header = ["StudentID","Nachname","Vorname"]
-        for i in range(1, task_count+1):
-            header.append(f"Aufgabe{i}")
-        header.extend(["OP","ZP"])
-        lines = [";".join(header)]
-        for s in stu_rows:
-            row_items = [str(s['id']), s['last_name'], s['first_name']]
-            row_items.extend(['' for _ in range(task_count)])
-            row_items.extend(['',''])
-            lines.append(";".join(row_items))
-        csv_content = "\n".join(lines)
-        filename = f"leistungsabfrage_{pid}.csv"
-        self.send_response(200)
-        self.send_header("Content-Type", "text/csv; charset=utf-8")
-        self.send_header("Content-Disposition", f"attachment; filename={filename}")
-        self.end_headers()
-        self.wfile.write(csv_content.encode('utf-8'))
+        self._send_performance_csv(pid, task_count, stu_rows)
 
     # ======= Grade Scales (Notenschlüssel) =======
     def _handle_grade_scales(self, params):
@@ -2139,8 +2737,8 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
             cur.execute("INSERT INTO grade_scales(name, definition) VALUES(?, ?)", (name, definition))
+            self._log_change('grade_scales', None, 'create', '', name, 'manual', None, cur=cur)
         conn.close()
-        self._log_change('grade_scales', None, 'create', '', name, 'manual', None)
         self._redirect('/grade_scales')
 
     def _post_assign_grade_scale(self):
@@ -2158,9 +2756,9 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         with conn:
             cur.execute("UPDATE performance_queries SET grade_scale_id=? WHERE id=?",
                         (scale_id if scale_id>0 else None, perf_id))
+            self._log_change('performance_queries', perf_id, 'grade_scale_id',
+                             str(old_val), str(scale_id if scale_id>0 else None), 'manual', None, cur=cur)
         conn.close()
-        self._log_change('performance_queries', perf_id, 'grade_scale_id',
-                         str(old_val), str(scale_id if scale_id>0 else None), 'manual', None)
         self._redirect(f"/performance?id={perf_id}")
 
     def _post_update_grade_override(self):
@@ -2178,62 +2776,56 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             override_val = None
         conn = get_db_connection(); cur = conn.cursor()
         old_row = cur.execute("SELECT grade_override, comment FROM performance_results WHERE performance_id=? AND student_id=?", (perf_id, student_id)).fetchone()
+        old_override = old_row['grade_override'] if old_row else None
+        old_comment = old_row['comment'] if old_row else None
         with conn:
             cur.execute("UPDATE performance_results SET grade_override=?, comment=? WHERE performance_id=? AND student_id=?",
                         (override_val, comment or None, perf_id, student_id))
+            if override_val != old_override or comment != (old_comment or ''):
+                self._log_change('performance_results', None, 'grade_override', str(old_override), str(override_val), 'manual', comment, cur=cur)
         conn.close()
-        old_override = old_row['grade_override'] if old_row else None
-        old_comment = old_row['comment'] if old_row else None
-        if override_val != old_override or comment != (old_comment or ''):
-            self._log_change('performance_results', None, 'grade_override', str(old_override), str(override_val), 'manual', comment)
         self._redirect(f"/performance?id={perf_id}")
 
     def _calculate_student_performance_grade(self, cur, performance_id, student_id):
         """Calculates the grade for a single student in a single performance assessment."""
 
-        performance = cur.execute("SELECT grade_scale_id FROM performance_queries WHERE id=?", (performance_id,)).fetchone()
-        if not performance or not performance['grade_scale_id']:
+        # Abfrage, Notenschlüssel, Maximalpunkte und die Punkte des Schülers in einem Rutsch
+        row = cur.execute(
+            "SELECT pq.grade_scale_id, gs.id AS scale_id, gs.definition, "
+            "COALESCE((SELECT SUM(max_points) FROM performance_tasks WHERE performance_id = pq.id), 0) AS total_max, "
+            "COALESCE(pr.op_points, 0) AS op_points, COALESCE(pr.zp_points, 0) AS zp_points, pr.grade_override, "
+            "COALESCE((SELECT SUM(points) FROM performance_task_results "
+            "          WHERE performance_id = pq.id AND student_id = ?), 0) AS task_sum "
+            "FROM performance_queries pq "
+            "LEFT JOIN grade_scales gs ON gs.id = pq.grade_scale_id "
+            "LEFT JOIN performance_results pr ON pr.performance_id = pq.id AND pr.student_id = ? "
+            "WHERE pq.id = ?",
+            (student_id, student_id, performance_id)
+        ).fetchone()
+        if not row or not row['grade_scale_id']:
             return None
 
-        tasks = cur.execute("SELECT number, max_points FROM performance_tasks WHERE performance_id=? ORDER BY number", (performance_id,)).fetchall()
-        total_max = sum(t['max_points'] for t in tasks)
+        total_max = row['total_max']
         if total_max == 0:
             return None # Avoid division by zero if there are no tasks with points
 
-        scale_row = cur.execute("SELECT definition FROM grade_scales WHERE id=?", (performance['grade_scale_id'],)).fetchone()
-        if not scale_row:
+        if row['scale_id'] is None:
             return None
 
-        scale_def = []
-        for ln in (scale_row['definition'] or '').splitlines():
-            parts = [p.strip() for p in ln.split(';')]
-            if len(parts) == 3:
-                try:
-                    scale_def.append((parts[0], float(parts[1]), float(parts[2])))
-                except ValueError:
-                    continue
+        scale_def = _parse_scale_def(row['definition'] or '')
 
         if not scale_def:
             return None
 
-        results = cur.execute("SELECT op_points, zp_points, grade_override FROM performance_results WHERE performance_id=? AND student_id=?", (performance_id, student_id)).fetchone()
-        task_results = cur.execute("SELECT points FROM performance_task_results WHERE performance_id=? AND student_id=?", (performance_id, student_id)).fetchall()
-
-        op = results['op_points'] if results else 0
-        zp = results['zp_points'] if results else 0
-        override = results['grade_override'] if results else None
-
-        task_sum = sum(r['points'] for r in task_results)
+        op = row['op_points']
+        zp = row['zp_points']
+        override = row['grade_override']
 
-        tot = task_sum + op + zp
+        tot = row['task_sum'] + op + zp
         tot_rounded = round(tot * 2.0) / 2.0
         pct = (tot_rounded / total_max * 100.0)
 
-        grade = ''
-        for g, mi, ma in scale_def:
-            if pct >= mi and pct < ma:
-                grade = g
-                break
+        grade = _grade_for_pct(scale_def, pct)
 
         final_grade = override if override is not None else grade
 
@@ -2252,6 +2844,17 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         if not all([performance_id, student_id, scores]):
             return self._send_json({'status': 'error', 'message': 'Missing data.'}, status=400)
 
+        # Eingaben einmal aufbereiten, bevor die Transaktion beginnt
+        task_rows = []
+        for key, value in scores.items():
+            if key.startswith('task_'):
+                try:
+                    task_number = int(key[5:].partition('_')[0])
+                    points = float(value)
+                except ValueError:
+                    continue
+                task_rows.append((performance_id, student_id, task_number, points))
+
         conn = get_db_connection()
         cur = conn.cursor()
 
@@ -2262,21 +2865,27 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             if 'zp_points' in scores:
                 cur.execute("UPDATE performance_results SET zp_points = ?, zp_is_edited = 1 WHERE performance_id = ? AND student_id = ?", (scores['zp_points'], performance_id, student_id))
 
-            # Update task results
-            for key, value in scores.items():
-                if key.startswith('task_'):
-                    try:
-                        task_number = int(key.split('_')[1])
-                        points = float(value)
-                    except (ValueError, IndexError):
-                        continue
-
-                    cur.execute("SELECT id FROM performance_task_results WHERE performance_id=? AND student_id=? AND task_number=?", (performance_id, student_id, task_number))
-                    existing = cur.fetchone()
-                    if existing:
-                        cur.execute("UPDATE performance_task_results SET points=?, is_edited=1 WHERE id=?", (points, existing['id']))
-                    else:
-                        cur.execute("INSERT INTO performance_task_results (performance_id, student_id, task_number, points, is_edited) VALUES (?, ?, ?, ?, 1)", (performance_id, student_id, task_number, points))
+            # Update task results (Upsert über ux_perf_task_results)
+            if _has_unique_index(cur, "ux_perf_task_results"):
+                cur.executemany(
+                    "INSERT INTO performance_task_results (performance_id, student_id, task_number, points, is_edited) "
+                    "VALUES (?, ?, ?, ?, 1) "
+                    "ON CONFLICT(performance_id, student_id, task_number) DO UPDATE SET points=excluded.points, is_edited=1",
+                    task_rows
+                )
+            else:
+                for perf_id, sid, task_number, points in task_rows:
+                    cur.execute(
+                        "UPDATE performance_task_results SET points=?, is_edited=1 "
+                        "WHERE performance_id=? AND student_id=? AND task_number=?",
+                        (points, perf_id, sid, task_number),
+                    )
+                    if cur.rowcount == 0:
+                        cur.execute(
+                            "INSERT INTO performance_task_results (performance_id, student_id, task_number, points, is_edited) "
+                            "VALUES (?, ?, ?, ?, 1)",
+                            (perf_id, sid, task_number, points),
+                        )
 
             # After updating, recalculate the grade to return to the client
             updated_data = self._calculate_student_performance_grade(cur, performance_id, student_id)
@@ -2294,23 +2903,9 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         date = (data.get('date') or '').strip()
         status = (data.get('status') or 'present').strip().lower()
         # Fehlstunden (Unterrichtsstunden) → Minuten
-        abs_units_raw = data.get('absent_units', '')
-        try:
-            abs_units = int(abs_units_raw) if abs_units_raw != '' else 0
-        except ValueError:
-            abs_units = 0
-        try:
-            absent_minutes_input = int(data.get('absent_minutes','0') or '0')
-        except ValueError:
-            absent_minutes_input = 0
-        absent_minutes = max(absent_minutes_input, abs_units * LESSON_MINUTES)
-
-        try:
-            late_minutes = int(data.get('late_minutes','0') or '0')
-        except ValueError:
-            late_minutes = 0
-        if absent_minutes < 0: absent_minutes = 0
-        if late_minutes < 0: late_minutes = 0
+        abs_units = _parse_int(data, 'absent_units')
+        absent_minutes = max(_parse_int(data, 'absent_minutes'), abs_units * LESSON_MINUTES)
+        late_minutes = _parse_int(data, 'late_minutes')
 
         db_status = 'present' if status == 'late' else status
         db_abs = absent_minutes if status == 'absent' else 0
@@ -2321,11 +2916,11 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             with conn:
                 cur.execute("INSERT INTO attendance_records(student_id, date, status, absent_minutes, late_minutes) VALUES(?,?,?,?,?)", (student_id, date, db_status, db_abs, db_late))
                 rec_id = cur.lastrowid
+                self._log_change('attendance_records', rec_id, 'create', '', f"{status};abs={db_abs};late={db_late}", 'manual', None, cur=cur)
         except Exception as e:
             conn.close()
             return self._send_html(f"<h1>500</h1><p>Fehler beim Speichern: {html_escape(e)}</p>", status=500)
         conn.close()
-        self._log_change('attendance_records', rec_id, 'create', '', f"{status};abs={db_abs};late={db_late}", 'manual', None)
         self._redirect(f"/student?id={student_id}&msg=Anwesenheit+eingetragen")
 
     def _handle_admin_attendance(self, params):
@@ -2364,124 +2959,126 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
         conn = get_db_connection()
         cur = conn.cursor()
         base = "SELECT id, timestamp, action, table_name, record_id, field_name, old_value, new_value, comment FROM change_log"
-        plist = []
+        where, plist = [], []
         if action_filter:
-            base += " WHERE action=?"
-            plist.append(action_filter)
-        base += " ORDER BY id DESC LIMIT 200"
+            where.append("action=?"); plist.append(action_filter)
+        # Seitenweise rückwärts blättern: ?before=<ID> setzt unter der letzten
+        # angezeigten ID an (Keyset über den Primärschlüssel, kein OFFSET)
+        before = _parse_positive_int(params.get('before', [''])[0])
+        if before:
+            where.append("id<?"); plist.append(before)
+        if where:
+            base += " WHERE " + " AND ".join(where)
+        base += " ORDER BY id DESC LIMIT ?"
+        plist.append(ADMIN_LOG_PAGE_SIZE)
         rows = cur.execute(base, tuple(plist)).fetchall()
         conn.close()
 
+        next_url = None
+        if len(rows) == ADMIN_LOG_PAGE_SIZE:
+            next_url = "/admin/log?" + urllib.parse.urlencode(
+                ([("action", action_filter)] if action_filter else []) + [("before", rows[-1]["id"])]
+            )
+
         context = {
             "logs": rows,
+            "next_url": next_url,
             "action_filter": action_filter,
             "actions": ['import', 'manual']
         }
         self.render("admin_log.html", context)
 
     # Logging helper
-    def _log_change(self, table_name: str, record_id: int | None, field_name: str, old_value: str, new_value: str, action: str, comment: str | None):
+    def _log_change(self, table_name: str, record_id: int | None, field_name: str, old_value: str, new_value: str, action: str, comment: str | None, cur=None):
+        """
+        Änderung protokollieren. Mit cur (Cursor oder Verbindung) läuft der Eintrag in der
+        Transaktion des Aufrufers mit (ein Commit für Änderung + Log), sonst eigene Verbindung.
+        """
+        params = (action, table_name, record_id, field_name, old_value, new_value, comment)
+        if cur is not None:
+            cur.execute(_LOG_CHANGE_SQL, params)
+            return
         conn = get_db_connection(); cur = conn.cursor()
         with conn:
-            cur.execute(
-                "INSERT INTO change_log(action, table_name, record_id, field_name, old_value, new_value, comment) VALUES(?,?,?,?,?,?,?)",
-                (action, table_name, record_id, field_name, old_value, new_value, comment)
-            )
+            cur.execute(_LOG_CHANGE_SQL, params)
         conn.close()
 
     # ----- Assignments & CRUD -----
     def _post_class_assign_teacher(self):
         data = self._parse_post()
-        cid = int(data.get('class_id','0') or '0')
-        tid_raw = data.get('teacher_id','0') or '0'
-        tid = int(tid_raw) if tid_raw.isdigit() else 0
+        cid = _parse_int(data, 'class_id')
+        tid = _parse_int(data, 'teacher_id')
         if cid<=0:
             return self._send_html("<h1>400</h1><p>Ungültige Daten.</p>", status=400)
         conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            if tid<=0:
-                cur.execute("UPDATE classes SET teacher_id=NULL WHERE id=?", (cid,))
-            else:
-                row = cur.execute("SELECT id FROM teachers WHERE id=?", (tid,)).fetchone()
-                if not row:
+        with conn.write_tx():
+            cur.execute(_ASSIGN_CLASS_TEACHER_SQL, (tid if tid>0 else None, cid))
+            if cur.rowcount == 0 and tid>0:
+                if not cur.execute("SELECT 1 FROM teachers WHERE id=?", (tid,)).fetchone():
                     conn.close(); return self._send_html("<h1>400</h1><p>Lehrer existiert nicht.</p>", status=400)
-                cur.execute("UPDATE classes SET teacher_id=? WHERE id=?", (tid, cid))
+            self._log_change('classes', cid, 'teacher_id', '', str(tid if tid>0 else None), 'manual', None, cur=cur)
         conn.close()
-        self._log_change('classes', cid, 'teacher_id', '', str(tid if tid>0 else None), 'manual', None)
         self._redirect('/classes')
 
     def _post_performance_delete(self):
         data = self._parse_post()
-        try:
-            pid = int(data.get('id','0') or '0')
-        except ValueError:
-            return self._send_html("<h1>400</h1><p>Ung&uuml;ltige ID.</p>", status=400)
+        pid = _parse_int(data, 'id')
         if pid <= 0:
             return self._send_html("<h1>400</h1><p>Ung&uuml;ltige ID.</p>", status=400)
-        conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            cur.execute("DELETE FROM performance_queries WHERE id=?", (pid,))
+        conn = get_db_connection()
+        with conn.write_tx():
+            conn.execute("DELETE FROM performance_queries WHERE id=?", (pid,))
+            self._log_change('performance_queries', pid, 'delete', '', '', 'manual', 'LA gelöscht', cur=conn)
         conn.close()
-        self._log_change('performance_queries', pid, 'delete', '', '', 'manual', 'LA gelöscht')
         self._redirect('/leistungsabfragen')
 
     def _post_course_assign_leader(self):
         data = self._parse_post()
-        course_id = int(data.get('course_id','0') or '0')
-        leader_raw = data.get('leader_id','0') or '0'
-        leader_id = int(leader_raw) if leader_raw.isdigit() else 0
+        course_id = _parse_int(data, 'course_id')
+        leader_id = _parse_int(data, 'leader_id')
         if course_id<=0:
             return self._send_html("<h1>400</h1><p>Ungültige Daten.</p>", status=400)
         conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            if leader_id<=0:
-                cur.execute("UPDATE courses SET leader_id=NULL WHERE id=?", (course_id,))
-            else:
-                row = cur.execute("SELECT id FROM teachers WHERE id=?", (leader_id,)).fetchone()
-                if not row:
+        with conn.write_tx():
+            cur.execute(_ASSIGN_COURSE_LEADER_SQL, (leader_id if leader_id>0 else None, course_id))
+            if cur.rowcount == 0 and leader_id>0:
+                if not cur.execute("SELECT 1 FROM teachers WHERE id=?", (leader_id,)).fetchone():
                     conn.close(); return self._send_html("<h1>400</h1><p>Lehrer existiert nicht.</p>", status=400)
-                cur.execute("UPDATE courses SET leader_id=? WHERE id=?", (leader_id, course_id))
+            self._log_change('courses', course_id, 'leader_id', '', str(leader_id if leader_id>0 else None), 'manual', None, cur=cur)
         conn.close()
-        self._log_change('courses', course_id, 'leader_id', '', str(leader_id if leader_id>0 else None), 'manual', None)
         self._redirect(f'/course?id={course_id}')
 
     def _post_enroll_update(self):
         data = self._parse_post()
-        student_id = int(data.get("student_id","0") or "0")
-        class_id = int(data.get("class_id","0") or "0")
-        course_id_raw = data.get("course_id","0") or "0"
-        course_id = int(course_id_raw) if course_id_raw.isdigit() else 0
+        student_id = _parse_int(data, "student_id")
+        class_id = _parse_int(data, "class_id")
+        course_id = _parse_int(data, "course_id")
         next_url = data.get("next") or "/"
         if student_id <= 0 or class_id <= 0:
             return self._send_html("<h1>400</h1><p>Ung&uuml;ltige Daten.</p>", status=400)
 
         conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            row = cur.execute("SELECT id FROM classes WHERE id=?", (class_id,)).fetchone()
-            if not row:
-                conn.close()
-                return self._send_html("<h1>400</h1><p>Klasse existiert nicht.</p>", status=400)
-            if course_id == 0:
-                cur.execute("UPDATE students SET class_id=?, course_id=NULL WHERE id=?", (class_id, student_id))
-            else:
-                row = cur.execute("SELECT id FROM courses WHERE id=?", (course_id,)).fetchone()
-                if not row:
+        with conn.write_tx():
+            cur.execute(_ENROLL_STUDENT_SQL, (class_id, course_id or None, student_id))
+            if cur.rowcount == 0:
+                # Nichts geändert: fehlende Klasse/Kurs melden; fehlender Schüler bleibt wie bisher folgenlos
+                if not cur.execute("SELECT 1 FROM classes WHERE id=?", (class_id,)).fetchone():
+                    conn.close()
+                    return self._send_html("<h1>400</h1><p>Klasse existiert nicht.</p>", status=400)
+                if course_id and not cur.execute("SELECT 1 FROM courses WHERE id=?", (course_id,)).fetchone():
                     conn.close()
                     return self._send_html("<h1>400</h1><p>Kurs existiert nicht.</p>", status=400)
-                cur.execute("UPDATE students SET class_id=?, course_id=? WHERE id=?", (class_id, course_id, student_id))
+            self._log_change('students', student_id, 'enroll', '', f'class={class_id};course={course_id or None}', 'manual', None, cur=cur)
         conn.close()
-        self._log_change('students', student_id, 'enroll', '', f'class={class_id};course={course_id or None}', 'manual', None)
         self._redirect(next_url)
 
     def _post_student_save(self):
         data = self._parse_post()
-        sid = int(data.get("id","0") or "0")
+        sid = _parse_int(data, "id")
         first = (data.get("first_name") or "").strip()
         last  = (data.get("last_name") or "").strip()
-        class_id_raw = data.get("class_id","0") or "0"
-        course_id_raw = data.get("course_id","0") or "0"
-        class_id = int(class_id_raw) if class_id_raw.isdigit() else 0
-        course_id = int(course_id_raw) if course_id_raw.isdigit() else 0
+        class_id = _parse_int(data, "class_id")
+        course_id = _parse_int(data, "course_id")
         class_new = (data.get("class_name_new") or "").strip()
         course_new = (data.get("course_name_new") or "").strip()
 
@@ -2489,8 +3086,10 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             return self._send_html("<h1>400</h1><p>Ung&uuml;ltige Eingaben.</p>", status=400)
 
         conn = get_db_connection(); cur = conn.cursor()
-        old_row = cur.execute("SELECT first_name,last_name,class_id,course_id FROM students WHERE id=?", (sid,)).fetchone()
-        with conn:
+        with conn.write_tx():
+            # Alte Werte fürs Protokoll unter der Schreibsperre lesen: kein paralleler
+            # Speichervorgang kann zwischen SELECT und UPDATE dazwischenkommen
+            old_row = cur.execute("SELECT first_name,last_name,class_id,course_id FROM students WHERE id=?", (sid,)).fetchone()
             if class_new:
                 class_id = get_or_create_class(cur, class_new)
             if course_new:
@@ -2498,23 +3097,18 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             if class_id <= 0:
                 conn.close()
                 return self._send_html("<h1>400</h1><p>Klasse fehlt/ung&uuml;ltig.</p>", status=400)
-            if course_id == 0:
-                cur.execute("UPDATE students SET first_name=?, last_name=?, class_id=?, course_id=NULL WHERE id=?",
-                            (first, last, class_id, sid))
-            else:
-                cur.execute("UPDATE students SET first_name=?, last_name=?, class_id=?, course_id=? WHERE id=?",
-                            (first, last, class_id, course_id, sid))
+            cur.execute(_UPDATE_STUDENT_SQL, (first, last, class_id, course_id or None, sid))
+            self._log_change('students', sid, 'update',
+                             f"{old_row['first_name']} {old_row['last_name']},c={old_row['class_id']},k={old_row['course_id']}",
+                             f"{first} {last},c={class_id},k={course_id or None}", 'manual', None, cur=cur)
         conn.close()
-        self._log_change('students', sid, 'update',
-                         f"{old_row['first_name']} {old_row['last_name']},c={old_row['class_id']},k={old_row['course_id']}",
-                         f"{first} {last},c={class_id},k={course_id or None}", 'manual', None)
+        _bump_ref_version()
         self._redirect(f"/student?id={sid}&msg=Gespeichert")
 
     def _post_course_create(self):
         data = self._parse_post()
         name = (data.get("course_name") or "").strip()
-        leader_id_raw = data.get("leader_id","0") or "0"
-        leader_id = int(leader_id_raw) if leader_id_raw.isdigit() else 0
+        leader_id = _parse_int(data, "leader_id")
         new_short = (data.get("new_teacher_short") or "").strip()
         new_name  = (data.get("new_teacher_name") or "").strip()
 
@@ -2522,61 +3116,53 @@ class SchoolHTTPRequestHandler(BaseHTTPRequestHandler):
             return self._send_html("<h1>400</h1><p>Kursname fehlt.</p>", status=400)
 
         conn = get_db_connection(); cur = conn.cursor()
-        with conn:
+        with conn.write_tx():
             if new_short or new_name:
                 tid = create_teacher(cur, new_short, new_name)
                 if tid: leader_id = tid
-            row = cur.execute("SELECT id FROM courses WHERE name=?", (name,)).fetchone()
-            if row:
-                if leader_id > 0:
-                    cur.execute("UPDATE courses SET leader_id=? WHERE id=?", (leader_id, row["id"]))
-            else:
-                cur.execute("INSERT INTO courses(name, class_id, leader_id) VALUES(?, NULL, ?)",
-                            (name, leader_id if leader_id>0 else None))
+            # Neuer Kurs oder bestehender (gleicher Name): Leiter nur setzen, wenn angegeben
+            cur.execute(_UPSERT_COURSE_SQL, (name, leader_id if leader_id>0 else None))
+            self._log_change('courses', None, 'create', '', name, 'manual', None, cur=cur)
         conn.close()
-        self._log_change('courses', None, 'create', '', name, 'manual', None)
+        _bump_ref_version()
         self._redirect("/courses")
 
     def _post_student_create(self):
         data = self._parse_post()
         first = (data.get("first_name") or "").strip()
         last  = (data.get("last_name") or "").strip()
-        class_id_raw = data.get("class_id","0") or "0"
-        course_id_raw = data.get("course_id","0") or "0"
-        class_id = int(class_id_raw) if class_id_raw.isdigit() else 0
-        course_id = int(course_id_raw) if course_id_raw.isdigit() else 0
+        class_id = _parse_int(data, "class_id")
+        course_id = _parse_int(data, "course_id")
         if not (first and last and class_id>0):
             return self._send_html("<h1>400</h1><p>Pflichtfelder fehlen.</p>", status=400)
-        conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            if course_id == 0:
-                cur.execute("INSERT INTO students(first_name, last_name, class_id, course_id) VALUES(?,?,?,NULL)",
-                            (first, last, class_id))
-            else:
-                cur.execute("INSERT INTO students(first_name, last_name, class_id, course_id) VALUES(?,?,?,?)",
-                            (first, last, class_id, course_id))
+        conn = get_db_connection()
+        with conn.write_tx():
+            conn.execute(_INSERT_STUDENT_SQL, (first, last, class_id, course_id or None))
+            self._log_change('students', None, 'create', '', f"{first} {last}", 'manual', None, cur=conn)
         conn.close()
-        self._log_change('students', None, 'create', '', f"{first} {last}", 'manual', None)
         self._redirect("/students")
 
     def _post_student_delete(self):
         data = self._parse_post()
-        sid = int(data.get("id","0") or "0")
+        sid = _parse_int(data, "id")
         if sid <= 0:
             return self._send_html("<h1>400</h1><p>ID fehlt.</p>", status=400)
-        conn = get_db_connection(); cur = conn.cursor()
-        with conn:
-            cur.execute("DELETE FROM students WHERE id=?", (sid,))
+        conn = get_db_connection()
+        with conn.write_tx():
+            conn.execute("DELETE FROM students WHERE id=?", (sid,))
+            self._log_change('students', sid, 'delete', '', '', 'manual', None, cur=conn)
         conn.close()
-        self._log_change('students', sid, 'delete', '', '', 'manual', None)
         self._redirect("/students")
 
 # =========================
 # HTTP Server
 # =========================
-def run(server_class=HTTPServer, handler_class=SchoolHTTPRequestHandler, port=8000):
+def run(server_class=ThreadingHTTPServer, handler_class=SchoolHTTPRequestHandler, port=8000):
     server_address = ("", port)
     httpd = server_class(server_address, handler_class)
+    httpd.daemon_threads = True  # offene Verbindungen blockieren das Beenden nicht
+    _ensure_schema()  # Migrationsfehler schon beim Start sichtbar machen
+    _warm_template_cache()
     print(f"Serving HTTP on port {port} (database: {DB_PATH}) ...")
     try:
         httpd.serve_forever()